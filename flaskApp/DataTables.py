@@ -1,6 +1,13 @@
 from MySQLdb import cursors, escape_string
 from flask import request
 from collections import defaultdict, namedtuple
+from decimal import Decimal
+import itertools
+import StringIO
+import hashlib
+import base64
+import json
+import csv
 import re
 
 # Sanitize all strings in JSON object to be safe from SQL injection
@@ -17,7 +24,11 @@ def sanitize_json(json):
 
 class DataTablesServer(object):
  
-    def __init__( self, request, index, table, db):
+    # cache is an optional ResultCache shared between requests
+    # rollups is a list of (table name, set of columns) of precomputed groupings of table
+    # total is the number of rows in table if known, otherwise it's counted
+    # version is the summaries version the request read, which cached results are kept under
+    def __init__( self, request, index, table, db, cache=None, rollups=(), total=None, version=None):
         print("Init datatables")
         
         self.index = index
@@ -34,6 +45,10 @@ class DataTablesServer(object):
 
         # pass MysqlDB cursor
         self.db = db
+        self.cache = cache
+        self.version = version
+        self.rollups = rollups
+        self.total = total
  
         # results from the db
         self.resultData = None
@@ -44,7 +59,7 @@ class DataTablesServer(object):
         # total in the table unfiltered
         self.cadinality = 0
         
-        self.run_queries()
+        self.load_results()
  
     def output_result(self):
         # return output
@@ -52,6 +67,9 @@ class DataTablesServer(object):
         output['draw'] = str(int(self.req_data['draw']))
         output['recordsTotal'] = str(self.cardinality)
         output['recordsFiltered'] = str(self.cadinalityFiltered)
+        next_cursor = self.next_cursor()
+        if next_cursor:
+            output['cursor'] = next_cursor
         data_rows = []
  
         for row in self.resultData:
@@ -67,30 +85,112 @@ class DataTablesServer(object):
         output['data'] = data_rows 
         return output
  
+    # The response as pieces of JSON text, a batch of rows at a time, so big pages aren't
+    # built up in memory. Columns that are hidden, so always "", are left out of the rows
+    # and "columns" lists the indexes of the ones sent. Averages and counts are numbers.
+    def output_chunks(self, batch_size=500):
+        columns = [idx for idx, name in enumerate(self.column_names) if self.column_kind(name) != 'hidden']
+        cells = [(self.column_names[idx], cell_encoders[self.column_kind(self.column_names[idx])])
+                    for idx in columns]
+
+        head = {'draw': int(self.req_data['draw']), 'recordsTotal': int(self.cardinality),
+                'recordsFiltered': int(self.cadinalityFiltered), 'columns': columns}
+        next_cursor = self.next_cursor()
+        if next_cursor:
+            head['cursor'] = next_cursor
+        yield json.dumps(head)[:-1] + ',"data":['
+
+        rows = iter(self.resultData)
+        separator = ''
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            yield separator + ','.join('[' + ','.join(encode(row[name]) for name, encode in cells) + ']'
+                                            for row in batch)
+            separator = ','
+        yield ']}'
+
+    # How columns_aggregate computes a column: 'hidden', 'param', 'sum' or 'avg'
+    def column_kind(self, name):
+        if not hasattr(self, 'column_idxs'):
+            self.column_idxs = {col_name: idx for idx, col_name in enumerate(self.column_names)}
+        idx = self.column_idxs[name]
+        col = self.columns[idx]
+        last_col_visible = idx > 0 and self.columns[idx-1]['visible']
+        if not col['visible'] and not (name[-2:]=='_N' and last_col_visible):
+            return 'hidden'
+        elif not col['searchable']:
+            return 'sum' if name[-2:] == '_N' else 'avg'
+        return 'param'
+
+    # Results for this request. With a cache, the page is shared by requests for the
+    # same view, and the filtered count by requests with the same filters and grouping,
+    # so paging and reordering don't count again.
+    def load_results(self):
+        self.resultData = self.cached(('page',) + self.cache_key(), self.run_queries)
+        self.cadinalityFiltered = self.cached(('filtered', self.source_table(), self.filtering(),
+                                               self.grouping()), self.count_filtered)
+        if self.total is None:
+            self.total = self.cached(('total', self.table), self.count_total)
+        self.cardinality = self.total
+
+    def cached(self, key, compute):
+        if self.cache is None:
+            return compute()
+        key = (self.version,) + key
+        value = self.cache.get(key)
+        if value is None:
+            value = compute()
+            self.cache.put(key, value)
+        return value
+
+    # Everything in the request that affects the page, which is everything but draw
+    def cache_key(self):
+        columns = tuple((col['name'], col.get('visible'), col.get('searchable'))
+                            for col in self.columns)
+        search = self.req_data['search']['value'] if self.req_data.has_key('search') else ""
+        order = tuple((order['column'], order['dir']) for order in self.req_data['order'])
+        return (self.table, columns, search, order, self.req_data['start'], self.req_data['length'])
+
+    # Rows of the requested page
     def run_queries(self):
         dataCursor = self.db.cursor(cursors.DictCursor) # replace the standard cursor with a dictionary cursor only for this query
-        query = """
-                SELECT SQL_CALC_FOUND_ROWS * FROM (
+        query = self.page_query()
+        print(query)
+        dataCursor.execute(query)
+        return dataCursor.fetchall()
+
+    def page_query(self):
+        return """
+                SELECT * FROM (
                     SELECT {columns}
                     FROM   {table} {where} {group}
-                ) t {order} {limit}""" .format(
-                columns=self.columns_aggregate(), table=self.table,
+                ) t {seek} {order} {limit}""" .format(
+                columns=self.columns_aggregate(), table=self.source_table(),
                 where=self.filtering(), order=self.ordering(), 
-                group=self.grouping(), limit=self.paging() 
+                group=self.grouping(), seek=self.seek(), limit=self.paging() 
             )
-        print(query)
-        dataCursor.execute(query)
-        self.resultData = dataCursor.fetchall()
 
+    # Rows in the table after filtering and grouping. Without grouping, the page query
+    # aggregates everything into one row.
+    def count_filtered(self):
+        if not self.grouping():
+            return 1
         cadinalityFilteredCursor = self.db.cursor()
-        cadinalityFilteredCursor.execute( """
-            SELECT FOUND_ROWS()
-        """ )
-        self.cadinalityFiltered = cadinalityFilteredCursor.fetchone()[0]
+        cadinalityFilteredCursor.execute(self.count_query())
+        return cadinalityFilteredCursor.fetchone()[0]
 
+    def count_query(self):
+        return """SELECT COUNT(*) FROM (
+                      SELECT 1 FROM {table} {where} {group}
+                  ) t""".format(table=self.source_table(), where=self.filtering(),
+                                group=self.grouping())
+
+    def count_total(self):
         cadinalityCursor = self.db.cursor()
         cadinalityCursor.execute( """SELECT COUNT(%s) FROM %s""" % (self.index, self.table))
-        self.cardinality = cadinalityCursor.fetchone()[0]
+        return cadinalityCursor.fetchone()[0]
 
     # Aggregates across columns that are visible and searchable.
     # Defines weighted average and response count functions
@@ -119,13 +219,27 @@ class DataTablesServer(object):
         return ','.join(column_strs)
 
  
+    # Words of the search box, only word characters are kept
+    def search_words(self):
+        if ( self.req_data.has_key('search') ) and ( self.req_data['search']['value'] != "" ):
+            return re.findall(r'\w+', self.req_data['search']['value'], re.UNICODE)
+        return []
+
+    # Every word of the search has to appear in one of the class's text columns, using
+    # the SearchText index built with ClassSummaries, which has no stopwords. Since words
+    # are only word characters, nothing in the search can reach the SQL or the fulltext
+    # query syntax.
     def filtering(self):
         filter = ""
-        if ( self.req_data.has_key('search') ) and ( self.req_data['search']['value'] != "" ):
-            filters = []
-            for i in range( len(self.columns) ):
-                filters.append("{} LIKE '%{}%'".format(self.column_names[i], self.req_data['search']['value']))
-            filter = "WHERE " + " OR ".join(filters)
+        words = self.search_words()
+        if words:
+            # The index is of 2 character pieces, so single characters can't use it
+            indexed = [word for word in words if len(word) >= 2]
+            filters = ["SearchText LIKE '%{}%'".format(word) for word in words if len(word) < 2]
+            if indexed:
+                filters.insert(0, "MATCH(SearchText) AGAINST('{}' IN BOOLEAN MODE)"
+                                    .format(" ".join('+"{}"'.format(word) for word in indexed)))
+            filter = "WHERE " + " AND ".join(filters)
 
         return filter
 
@@ -143,43 +257,236 @@ class DataTablesServer(object):
         #    filter['$and'] = and_filter_individual_columns
         #return filter
 
-    def ordering( self ):
-        order_str = ""
+    # Sort keys as (ORDER BY term, column, direction, whether nulls sort last).
+    # The grouped columns come last, so every row has a distinct key and keyset
+    # paging (see seek) can't skip or repeat rows with equal values.
+    def order_keys(self):
+        keys = []
         if self.req_data['order'][0]['column'] != "":
-            orders = []
             for order in self.req_data['order']:
                 # Validate input
                 col_i = int(order['column'])
-                #order_dir = order['dir'] if order['dir'] in ['asc','desc'] else None
-                #orders.append("{} {}".format(self.column_names[col_i], order_dir))
+                order_dir = 'asc' if order['dir']=='asc' else 'desc'
+                name = self.column_names[col_i]
 
                 #if this is a data column
-                if self.column_names[col_i]+'_N' in self.column_names:
+                if name+'_N' in self.column_names:
                     # In order to sort nulls last, sort "col asc" as "-col desc" instead
-                    order_prefix = '-' if order['dir']=='asc' else ''
-                    orders.append("{}{} DESC".format(order_prefix, self.column_names[col_i]))  
+                    order_prefix = '-' if order_dir=='asc' else ''
+                    keys.append(("{}{} DESC".format(order_prefix, name), name, order_dir, True))
                     # Secondary sort by number of responses              
-                    orders.append("{}{} DESC".format(order_prefix, self.column_names[col_i]+"_N"))
-                else: #This is a param column
-                    orders.append("{} {}".format(self.column_names[col_i], order['dir']))
-            order_str = "ORDER BY " + ",".join(orders)
-           
+                    keys.append(("{}{} DESC".format(order_prefix, name+"_N"), name+"_N", order_dir, True))
+                else: #This is a param column. MySQL sorts nulls first ascending, last descending
+                    keys.append(("{} {}".format(name, order_dir), name, order_dir, order_dir=='desc'))
+
+            ordered = set(key[1] for key in keys)
+            keys += [("{} asc".format(name), name, 'asc', False)
+                        for name in self.group_columns() or [] if name not in ordered]
+        return keys
+
+    def ordering( self ):
+        order_str = ""
+        keys = self.order_keys()
+        if keys:
+            order_str = "ORDER BY " + ",".join(key[0] for key in keys)
         return order_str
 
+    # Keyset paging: instead of making MySQL sort and throw away every row before start,
+    # a cursor holds anchors, the sort keys of rows of the previous page, and the page
+    # starts after one of them. Clients send back the cursor from the last response.
+    # Scrolling asks for windows overlapping the last one, so there are anchors at each
+    # quarter of the page, and the page seeks to the last one at or before start and
+    # skips the few rows between. A cursor for another view, or with no anchor before
+    # start, falls back to LIMIT start, length, so jumping to any page still works.
+    def keyset_possible(self):
+        return (bool(self.group_columns()) and self.req_data['length'] != -1
+                and self.req_data['start'] != "")
+
+    # Identifies the filtering, grouping and order a cursor is valid for
+    def view_signature(self):
+        return hashlib.sha1("\n".join([self.filtering(), self.grouping(), self.ordering()])
+                                .encode('utf-8')).hexdigest()[:16]
+
+    cursor_anchors = 4
+
+    def next_cursor(self):
+        if not self.keyset_possible() or len(self.resultData) < self.req_data['length']:
+            return None
+        count = len(self.resultData)
+        # An anchor at position p holds the keys of row p-1, so seeking starts at row p
+        ends = sorted(set(max(1, count*k//self.cursor_anchors) for k in range(1, self.cursor_anchors+1)))
+        anchors = [[self.req_data['start'] + end,
+                    [encode_value(self.resultData[end-1][key[1]]) for key in self.order_keys()]]
+                        for end in ends]
+        payload = {'view': self.view_signature(), 'anchors': anchors}
+        return base64.urlsafe_b64encode(json.dumps(payload))
+
+    # (rows to skip, sort key values of the row before them) for this page, or None to
+    # use offset paging
+    def cursor_anchor(self):
+        if not self.keyset_possible() or not self.req_data.get('cursor'):
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(str(self.req_data['cursor'])))
+            if payload['view'] != self.view_signature():
+                return None
+            usable = [(position, keys) for position, keys in payload['anchors']
+                        if position <= self.req_data['start'] and len(keys) == len(self.order_keys())]
+            if not usable:
+                return None
+            position, keys = max(usable)
+            return self.req_data['start'] - position, [decode_value(value) for value in keys]
+        except (TypeError, ValueError, KeyError):
+            return None
+
+    # WHERE clause selecting the rows sorted after the cursor's row
+    def seek(self):
+        anchor = self.cursor_anchor()
+        if anchor is None:
+            return ""
+        values = anchor[1]
+
+        # Rows equal on the first keys and after on the next one
+        alternatives = []
+        for idx, ((term, name, order_dir, nulls_last), value) in enumerate(zip(self.order_keys(), values)):
+            if value == 'NULL':
+                after = "{} IS NOT NULL".format(name) if not nulls_last else None
+            else:
+                after = "{} {} {}".format(name, '>' if order_dir=='asc' else '<', value)
+                if nulls_last:
+                    after = "({} OR {} IS NULL)".format(after, name)
+            if after:
+                equal = ["{} <=> {}".format(key[1], prev) for key, prev in zip(self.order_keys()[:idx], values)]
+                alternatives.append("(" + " AND ".join(equal + [after]) + ")")
+
+        return "WHERE " + (" OR ".join(alternatives) if alternatives else "FALSE")
+
+    # Columns to group by, or None if we aren't passed visibility info
+    def group_columns(self):
+        if not self.columns[0].has_key('visible'):
+            return None
+        return [col['name'] for col in self.columns 
+                    if col['visible']==True and # Group by visible param cols
+                       col['searchable']==True] # Searchable, i.e. param columns
+
     def grouping(self):
-        group_str = ""
-        #if we're passing visiblity info
-        if self.columns[0].has_key('visible'):
-            groups = [col['name'] for col in self.columns 
-                        if col['visible']==True and # Group by visible param cols
-                           col['searchable']==True] # Searchable, i.e. param columns
-            group_str = "GROUP BY " + ",".join(groups) if groups else ""
-
-        return group_str
+        groups = self.group_columns()
+        return "GROUP BY " + ",".join(groups) if groups else ""
+
+    # Table to aggregate: the smallest rollup grouped by at least the columns we group
+    # by, which gives the same averages as the whole table for far fewer rows. Searches
+    # filter on every column of the base table, so they can't use a rollup.
+    def source_table(self):
+        groups = self.group_columns()
+        if groups is None or self.filtering():
+            return self.table
+
+        candidates = [(len(cols), name) for name, cols in self.rollups if set(groups) <= cols]
+        return min(candidates)[1] if candidates else self.table
  
     def paging(self):
         limit_str = ""
         if ( self.req_data['start'] != "" ) and ( self.req_data['length'] != -1 ):
-            limit_str = "LIMIT {:d}, {:d}".format(self.req_data['start'], self.req_data['length'] )
+            anchor = self.cursor_anchor()
+            if anchor is not None: # Starting after the anchor's row, see seek
+                limit_str = "LIMIT {:d}, {:d}".format(anchor[0], self.req_data['length'])
+            else:
+                limit_str = "LIMIT {:d}, {:d}".format(self.req_data['start'], self.req_data['length'] )
         return limit_str
 
+# JSON for a cell of each kind of column (see column_kind). Averages are rounded to 4
+# places, which is more than the table shows, and response counts are integers.
+def encode_number(value, places):
+    try:
+        value = round(float(value), places)
+    except (TypeError, ValueError): # NULL, or empty for a class without the question
+        return 'null'
+    if value != value: # NaN
+        return 'null'
+    return repr(int(value)) if places == 0 else repr(value)
+
+cell_encoders = {
+    'avg': lambda value: encode_number(value, 4),
+    'sum': lambda value: encode_number(value, 0),
+    'param': lambda value: json.dumps(value, default=unicode),
+}
+
+# Sort key values in cursors are kept as SQL literals, so they compare exactly the same
+# way when sent back. Numbers are checked to be numbers before they go into a query.
+number_literal = re.compile(r'^-?\d+(\.\d+)?([eE][-+]?\d+)?$')
+
+def encode_value(value):
+    if value is None:
+        return 'NULL'
+    elif isinstance(value, (int, long, Decimal)):
+        return ['num', str(value)]
+    elif isinstance(value, float):
+        return ['num', repr(value)]
+    elif isinstance(value, str):
+        return ['str', value.decode('utf-8')]
+    return ['str', unicode(value)]
+
+def decode_value(value):
+    if value == 'NULL':
+        return 'NULL'
+    kind, literal = value
+    if kind == 'num' and number_literal.match(literal):
+        return literal
+    elif kind == 'str':
+        return "'{}'".format(escape_string(literal))
+    raise ValueError("Bad cursor value")
+
+
+# Every row of a view, with its filtering, grouping and order, for downloading.
+# Rows come from a server side cursor a batch at a time and are written out as they
+# arrive, so memory use doesn't grow with the size of the view.
+class DataTablesExport(DataTablesServer):
+    # Instead of loading a page, export all rows, see row_batches
+    def load_results(self):
+        self.req_data['start'] = 0
+        self.req_data['length'] = -1
+
+    # Columns in the export: the ones that aren't hidden, as (name, kind)
+    def export_columns(self):
+        return [(name, self.column_kind(name)) for name in self.column_names
+                    if self.column_kind(name) != 'hidden']
+
+    def row_batches(self, batch_size=1000):
+        dataCursor = self.db.cursor(cursors.SSDictCursor)
+        try:
+            dataCursor.execute(self.page_query())
+            while True:
+                batch = dataCursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            dataCursor.close()
+
+    def csv_chunks(self):
+        columns = self.export_columns()
+        out = StringIO.StringIO()
+        writer = csv.writer(out)
+        writer.writerow([name for name, kind in columns])
+        for batch in self.row_batches():
+            for row in batch:
+                writer.writerow([csv_cell(row[name], kind) for name, kind in columns])
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+        yield out.getvalue()
+
+    # One JSON object per line
+    def ndjson_chunks(self):
+        columns = [(json.dumps(name), cell_encoders[kind]) for name, kind in self.export_columns()]
+        names = [name for name, kind in self.export_columns()]
+        for batch in self.row_batches():
+            yield "".join('{' + ','.join(key + ':' + encode(row[name])
+                                             for name, (key, encode) in zip(names, columns)) + '}\n'
+                            for row in batch)
+
+def csv_cell(value, kind):
+    if kind == 'param':
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+    text = cell_encoders[kind](value)
+    return '' if text == 'null' else text
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+# Compare the MySQL and in-memory DataTables engines on the configured database:
+# times a set of typical table requests with each, and checks they return the same
+# rows and counts.
+#
+# bench_engines.py [-r REPEATS]
+
+from __future__ import print_function
+from DataTables import DataTablesServer
+from memory_engine import SummaryArrays, MemoryDataTablesServer, collation_key
+from schema import SummarySchema
+from os import path
+import ConfigParser
+import MySQLdb
+import StringIO
+import getopt
+import time
+import sys
+
+# Stands in for flask's request
+class FakeRequest(object):
+    def __init__(self, data):
+        self.data = data
+
+    def get_json(self, force=False):
+        return self.data
+
+def request_data(schema, visible, order_col, order_dir='desc', search="", start=0, length=25):
+    columns = [dict(col, visible=col['name'] in visible) for col in schema.columns]
+    names = [col['name'] for col in columns]
+    return {'draw': 1, 'columns': columns, 'start': start, 'length': length,
+            'order': [{'column': names.index(order_col), 'dir': order_dir}],
+            'search': {'value': search, 'regex': False}}
+
+# The default view, the common groupings, searches and deep pages
+def typical_requests(schema):
+    quality = schema.col_names[schema.avg_col_idxs[0]]
+    default = ["AcademicYear","Instructor","Course",quality]
+    return [
+        ('default', request_data(schema, default, quality)),
+        ('ascending', request_data(schema, default, quality, 'asc')),
+        ('by instructor', request_data(schema, ["Instructor",quality], quality)),
+        ('by course', request_data(schema, ["Course",quality], quality)),
+        ('by dept/year', request_data(schema, ["Department","AcademicYear",quality], "AcademicYear")),
+        ('search', request_data(schema, default, quality, search="cs")),
+        ('search 2 words', request_data(schema, default, quality, search="cs 21")),
+        ('deep page', request_data(schema, default, quality, start=5000)),
+    ]
+
+def same_value(a, b):
+    if isinstance(a, (int, long, float)) or isinstance(b, (int, long, float)):
+        try:
+            return abs(float(a) - float(b)) < 1e-6
+        except (TypeError, ValueError):
+            return a is None and b is None
+    return collation_key(a) == collation_key(b)
+
+def compare(sql, memory):
+    problems = []
+    if int(sql['recordsFiltered']) != int(memory['recordsFiltered']):
+        problems.append("recordsFiltered {} != {}".format(sql['recordsFiltered'], memory['recordsFiltered']))
+    for idx, (sql_row, memory_row) in enumerate(zip(sql['data'], memory['data'])):
+        for col, (a, b) in enumerate(zip(sql_row, memory_row)):
+            if a != b and not same_value(none_or(a), none_or(b)):
+                problems.append("row {} column {}: {!r} != {!r}".format(idx, col, a, b))
+    if len(sql['data']) != len(memory['data']):
+        problems.append("{} rows != {} rows".format(len(sql['data']), len(memory['data'])))
+    return problems
+
+def none_or(text):
+    return None if text == 'None' else text
+
+def timed(make, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        result = make().output_result()
+        times.append(time.time() - start)
+    return result, sorted(times)[len(times)//2]
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "r:")
+    except getopt.GetoptError:
+        print("bench_engines.py [-r REPEATS]")
+        return 2
+    repeats = 5
+    for opt, arg in opts:
+        if opt == '-r':
+            repeats = int(arg)
+
+    cfg = ConfigParser.ConfigParser()
+    cfg.read(path.join(path.dirname(path.abspath(__file__)), 'database.cfg'))
+    opt = cfg._sections['MySQL database']
+    db = MySQLdb.connect(host=opt['hostname'], db=opt['database'], user=opt['username'],
+                         passwd=opt['password'], charset='utf8')
+
+    schema = SummarySchema.load(db, [])
+    start = time.time()
+    arrays = SummaryArrays.load(db)
+    print("Loaded {} rows into memory in {:.2f}s".format(arrays.size, time.time() - start))
+
+    mismatches = 0
+    print("{:16} {:>10} {:>10} {:>8}".format('request', 'mysql ms', 'memory ms', 'speedup'))
+    for name, data in typical_requests(schema):
+        # DataTablesServer prints its queries
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            sql, sql_time = timed(lambda: DataTablesServer(FakeRequest(data), 'CRN', 'ClassSummaries',
+                                                           db, rollups=schema.rollups), repeats)
+            memory, memory_time = timed(lambda: MemoryDataTablesServer(FakeRequest(data), 'CRN',
+                                                                       'ClassSummaries', arrays), repeats)
+        finally:
+            sys.stdout = stdout
+
+        print("{:16} {:10.1f} {:10.1f} {:7.1f}x".format(name, sql_time*1000, memory_time*1000,
+                                                        sql_time/max(memory_time, 1e-9)))
+        for problem in compare(sql, memory):
+            mismatches += 1
+            print("  {}".format(problem))
+
+    print("{} mismatches".format(mismatches))
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# Show MySQL's plans for the queries behind typical table requests (the same ones
+# bench_engines.py times), to check they read the rollups and use their indexes
+# (see Database.indexes). Each table a query reads is listed with the index used, if
+# any, and the rows MySQL expects to examine.
+#
+# explain_queries.py [-v]
+#   -v  also print each query
+
+from __future__ import print_function
+from DataTables import DataTablesServer
+from bench_engines import FakeRequest, typical_requests
+from schema import SummarySchema
+from MySQLdb import cursors
+from os import path
+import ConfigParser
+import MySQLdb
+import StringIO
+import getopt
+import sys
+
+def explain(db, query):
+    cursor = db.cursor(cursors.DictCursor)
+    cursor.execute("EXPLAIN " + query)
+    return cursor.fetchall()
+
+# Whole table reads of base tables. Derived tables (<derivedN>) are
+# the grouped results themselves, which are always read whole.
+def full_scans(plan):
+    return [step for step in plan if step['type'] == 'ALL' and not (step['table'] or '').startswith('<')]
+
+def print_plan(plan):
+    for step in plan:
+        print("    {:24} {:8} {:32} {:>8}  {}".format(step['table'], step['type'], step['key'] or '-',
+                                                   step['rows'], step['Extra'] or ''))
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "v")
+    except getopt.GetoptError:
+        print("explain_queries.py [-v]")
+        return 2
+    verbose = ('-v', '') in opts
+
+    cfg = ConfigParser.ConfigParser()
+    cfg.read(path.join(path.dirname(path.abspath(__file__)), 'database.cfg'))
+    opt = cfg._sections['MySQL database']
+    db = MySQLdb.connect(host=opt['hostname'], db=opt['database'], user=opt['username'],
+                         passwd=opt['password'], charset='utf8')
+
+    schema = SummarySchema.load(db, [])
+    scans = 0
+    for name, data in typical_requests(schema):
+        # DataTablesServer prints what it's doing
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            server = DataTablesServer(FakeRequest(data), 'CRN', 'ClassSummaries', db, rollups=schema.rollups)
+        finally:
+            sys.stdout = stdout
+
+        print("{} (from {})".format(name, server.source_table()))
+        for kind, query in [('page', server.page_query()), ('count', server.count_query())]:
+            plan = explain(db, query)
+            print("  {}".format(kind))
+            if verbose:
+                print(query)
+            print_plan(plan)
+            scans += len(full_scans(plan))
+
+    print("{} full table scans".format(scans))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
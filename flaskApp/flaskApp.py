@@ -1,11 +1,15 @@
-from flask import Flask, render_template, request
-from DataTables import DataTablesServer
+from flask import Flask, Response, render_template, request, g
+from DataTables import DataTablesServer, DataTablesExport
+from result_cache import ResultCache
+from pool import ConnectionPool
+from schema import SummarySchema, PerVersion
 import json
+import zlib
 import ConfigParser
 from os import path
 
-from flaskext.mysql import MySQL
-from MySQLdb import cursors
+import MySQLdb
+from MySQLdb import cursors, ProgrammingError
 
 app = Flask(__name__)
 
@@ -14,44 +18,64 @@ cfg = ConfigParser.ConfigParser()
 cfg.read(path.join(path.dirname(__file__), 'database.cfg'))
 opt = cfg._sections['MySQL database']
 
-app.config['MYSQL_DATABASE_HOST'] = opt['hostname']
-app.config['MYSQL_DATABASE_USER'] = opt['username']
-app.config['MYSQL_DATABASE_PASSWORD'] = opt['password']
-app.config['MYSQL_DATABASE_DB'] = opt['database']
+# Connections shared by all requests. Every query is its own transaction: one kept open
+# across a summaries build's RENAME can't read the tables it published.
+pool = ConnectionPool(lambda: MySQLdb.connect(host = opt['hostname'],
+                                              db = opt['database'],
+                                              user = opt['username'],
+                                              passwd = opt['password'],
+                                              charset = 'utf8',
+                                              autocommit = True),
+                      size = int(opt.get('pool_size', 8)))
 
-mysql = MySQL()
-mysql.init_app(app)
+# This request's connection, taken from the pool on first use
+def get_db():
+    if not hasattr(g, 'db'):
+        g.db = pool.get()
+    return g.db
+
+@app.teardown_appcontext
+def return_db(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        pool.put(db)
 
 # Columns visible on start
 visible_cols = ["AcademicYear","Instructor","Course","CourseQuality"]
 
+# Column layout of ClassSummaries, loaded once per summaries version
+schemas = PerVersion(lambda db: SummarySchema.load(db, visible_cols))
+
+# Answer DataTables requests from arrays in memory instead of MySQL, see memory_engine.py
+memory_arrays = None
+if opt.get('engine') == 'memory':
+    from memory_engine import SummaryArrays, MemoryDataTablesServer
+    memory_arrays = PerVersion(SummaryArrays.load)
+
+# DataTables results shared between requests, most people look at the same few views
+result_cache = ResultCache()
+
+# Version of ClassSummaries, bumped by build_class_summaries whenever it changes, and
+# its number of rows, stored with it. Either is None if summaries were built before
+# build_class_summaries recorded it.
+def summaries_state(db):
+    cursor = db.cursor()
+    try:
+        cursor.execute("SELECT Name,Value FROM SummaryState WHERE Name IN ('Version','SummaryRows')")
+    except ProgrammingError:
+        return None, None
+    state = dict(cursor.fetchall())
+    return state.get('Version'), state.get('SummaryRows')
+
 @app.route('/hello_world')
 def hello_world():
         return 'Hello World!'
 
 @app.route('/')
 def main():
-    db = mysql.get_db()
-    cursor = db.cursor(cursors.DictCursor)
-    cursor.execute("DESCRIBE ClassSummaries")
-    col_names = [entry['Field'] for entry in cursor.fetchall()]
-        
-    sample_col_idxs = [idx for idx,name in enumerate(col_names) if name[-2:] == '_N']
-    avg_col_idxs = [idx for idx,name in enumerate(col_names) if name+'_N' in col_names]
-    param_col_idxs = [idx for idx in range(len(col_names)) if idx not in sample_col_idxs+avg_col_idxs]
-    init_order = [[avg_col_idxs[0], 'desc']]    
-    columns = [{"title": name, 
-                "name": name, 
-                # param cols are searchable, value cols aren't
-                "searchable": idx not in sample_col_idxs+avg_col_idxs,
-                "visible": name in visible_cols}
-                    for idx,name in enumerate(col_names)]
-    
-    return render_template('index.html',columns = json.dumps(columns),
-                                        sample_col_idxs = json.dumps(sample_col_idxs),
-                                        avg_col_idxs = json.dumps(avg_col_idxs),
-                                        param_col_idxs = json.dumps(param_col_idxs),
-                                        init_order = json.dumps(init_order))
+    db = get_db()
+    version, total = summaries_state(db)
+    return render_template('index.html', **schemas.get(db, version).page_json)
 
 @app.route("/server_data", methods=['POST'])
 def get_server_data():
@@ -63,91 +87,215 @@ def get_server_data():
     index_column = "CRN" #!!
     table = "ClassSummaries"
 
-    db = mysql.get_db()
-    cursor = db.cursor(cursors.DictCursor)
+    db = get_db()
 
-    results = DataTablesServer(request, index_column, table, db).output_result()
+    version, total = summaries_state(db)
+    result_cache.set_version(version)
+    if memory_arrays:
+        server = MemoryDataTablesServer(request, index_column, table,
+                                        memory_arrays.get(db, version), result_cache, version)
+    else:
+        server = DataTablesServer(request, index_column, table, db, result_cache,
+                                  schemas.get(db, version).rollups, total, version)
 
-    # return the results as json # import json
     print("Done")
-    return json.dumps(results)
+    return stream_json(server.output_chunks())
+
+# Send JSON as its chunks are made, gzipped or deflated if the client accepts it
+def stream_json(chunks):
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        wbits = 16 + zlib.MAX_WBITS # gzip header
+        headers['Content-Encoding'] = 'gzip'
+    elif request.accept_encodings['deflate']:
+        wbits = zlib.MAX_WBITS # zlib header, which is what HTTP calls deflate
+        headers['Content-Encoding'] = 'deflate'
+    else:
+        return Response((chunk.encode('utf-8') for chunk in chunks),
+                        mimetype='application/json', headers=headers)
+
+    def compressed():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8'))
+            if data:
+                yield data
+        yield compressor.flush()
+    return Response(compressed(), mimetype='application/json', headers=headers)
+
+# A DataTables request passed as json in a view parameter, from the url or a posted
+# form, so a plain link or form can download a view
+class ViewRequest(object):
+    def __init__(self, data):
+        self.data = data
+
+    def get_json(self, force=False):
+        return self.data
+
+export_formats = {'csv': ('text/csv', DataTablesExport.csv_chunks),
+                  'ndjson': ('application/x-ndjson', DataTablesExport.ndjson_chunks)}
+
+# Download every row of a view, in the order and grouping it's shown in, as csv or ndjson.
+# Takes the same request as /server_data, posted as json or in the view parameter of the
+# url or a posted form, and ignores its paging.
+@app.route("/export", methods=['GET', 'POST'])
+def export():
+    fmt = request.values.get('format', 'csv')
+    if fmt not in export_formats:
+        return "Unknown format {}".format(fmt), 400
+    if 'view' in request.values:
+        try:
+            view = ViewRequest(json.loads(request.values['view']))
+        except ValueError:
+            return "View isn't json", 400
+        if not isinstance(view.data, dict):
+            return "View isn't a DataTables request", 400
+    elif request.method == 'POST':
+        view = request
+    else:
+        return "No view to export", 400
+
+    # Rows are still being read after this returns, which is after the request's own
+    # connection has gone back to the pool, so the export gets one of its own. It goes
+    # back when the response is closed, which happens even if the rows are never read,
+    # like for a HEAD request.
+    db = pool.get()
+    try:
+        version, total = summaries_state(db)
+        exporter = DataTablesExport(view, "CRN", "ClassSummaries", db,
+                                    rollups=schemas.get(db, version).rollups)
+    except Exception:
+        pool.put(db)
+        raise
 
-# Predict metrics for a list of CRNS, using knowlege about past classes
-#!! untested
-def predict_for_crns(crns, out_cols):
-    db = mysql.get_db()
+    mimetype, chunks = export_formats[fmt]
+    response = Response(chunks(exporter), mimetype=mimetype,
+                        headers={'Content-Disposition': 'attachment; filename=summaries.{}'.format(fmt)})
+    response.call_on_close(lambda: pool.put(db))
+    return response
+
+# Hit rate and memory use of the DataTables result cache, and connection pool use
+@app.route("/cache_stats")
+def cache_stats():
+    return json.dumps(dict(result_cache.stats(), pool=pool.stats()))
+
+# Ways to predict a class, most specific first: the columns past classes have to share
+# with it. perfect and courseAndProf are used alone if they match. Otherwise the class is
+# predicted from its course and/or instructor, see predict_for_crns.
+predict_levels = [('perfect', ['Course','Name','Instructor']),
+                  ('courseAndProf', ['Course','Instructor']),
+                  ('prof', ['Instructor']),
+                  ('course', ['Course'])]
+
+# MySQL matches strings ignoring case and trailing spaces, so keys have to as well
+def match_key(row, cols):
+    return tuple(row[col].lower().rstrip(' ') if isinstance(row[col], basestring) else row[col]
+                    for col in cols)
+
+# Weighted averages of out_cols for past classes grouped by cols, for each of keys (tuples
+# of values of cols), in one query, by match_key. Reads the rollup grouped by cols if there
+# is one.
+def averages_by(cur, schema, cols, keys, out_cols):
+    if not keys:
+        return {}
+    averages = ["SUM({avg}*{avg}_N)/SUM({avg}_N) AS {avg}, SUM({avg}_N) AS {avg}_N".format(avg=col)
+                    for col in out_cols]
+    key_params = "({})".format(",".join(["%s"]*len(cols)))
+    cur.execute("""SELECT {cols},{averages} FROM {table}
+                   WHERE ({cols}) IN ({keys})
+                   GROUP BY {cols}""".format(cols=",".join(cols), averages=",".join(averages),
+                                             table=schema.rollup_table(cols) or "ClassSummaries",
+                                             keys=",".join([key_params]*len(keys))),
+                [value for key in keys for value in key])
+    return {match_key(row, cols): row for row in cur.fetchall()}
+
+# Predict out_cols for a list of CRNS, using knowlege about past classes. Each level of
+# predict_levels is one query for every class that still needs it, so a whole schedule
+# takes at most five queries.
+def predict_for_crns(db, schema, crns, out_cols):
     cur = db.cursor(cursors.DictCursor)
+    if not crns:
+        return []
+
+    # The class each CRN is, from its most recent year. Classes is read, not
+    # ClassSummaries, so upcoming classes with no evaluations yet can be predicted.
+    cur.execute("""SELECT CRN,CONCAT(Department,'-',Code) AS Course,Name,Instructor FROM Classes
+                   WHERE CRN IN ({}) ORDER BY AcademicYear DESC""".format(",".join(["%s"]*len(crns))), crns)
+    classes = {}
+    for row in cur.fetchall():
+        classes.setdefault(int(row['CRN']), row)
+
+    # Matching past classes for each level, by CRN
+    matches = {crn: {} for crn in classes}
+    remaining = set(classes)
+    for method, cols in predict_levels:
+        keys = {match_key(classes[crn], cols): tuple(classes[crn][col] for col in cols)
+                    for crn in remaining}
+        keys = [key for key in keys.values() if None not in key]
+        rows = averages_by(cur, schema, cols, keys, out_cols)
+        for crn in remaining:
+            row = rows.get(match_key(classes[crn], cols))
+            if row:
+                matches[crn][method] = row
+        if method in ('perfect', 'courseAndProf'): # Nothing less specific needed
+            remaining = set(crn for crn in remaining if method not in matches[crn])
 
     data = []
     for crn in crns:
         data.append({'crn':crn})
-
-        # Try to get info about the specific class queried
-        cur.execute("SELECT Department,Code,Name,Professor FROM Classes WHERE CRN=%s",crn)
-        class_info = cur.fetchone()
-        if not class_info: # CRN not in the database, we're done
+        if crn not in classes: # CRN not in the database, we're done
             data[-1]['method'] = None
             continue
+        data[-1].update((col, classes[crn][col]) for col in ['Course','Name','Instructor'])
 
-        data[-1].update(class_info)
-
-        summaries = ["SUM({avg}*{samples})/SUM({samples} AS {avg}, SUM({samples}) AS {samples}"
-                                    .format(avg=col, samples=col+"_N") for col in out_cols]
-        cur.execute("""SELECT {summaries} FROM ClassSummaries WHERE 
-                                            Course={Department}-{Code},
-                                            Name={Name},
-                                            Professor={Professor}
-                                        GROUP BY
-                                            Course,Name,Professor"""
-                                            .format(summaries=summaries,**class_info))
-        result = cur.fetchone()
-        if result:
-            data[-1].update(result)
-            data[-1]['method'] = 'perfect'
-            continue #we're done
-
-        # If we couldn't find any matches, ignore the course name
-        cur.execute("""SELECT {summaries} FROM ClassSummaries WHERE 
-                                    Course={Department}-{Code},
-                                    Professor={Professor}
-                                GROUP BY
-                                    Course,Professor"""
-                                    .format(summaries=summaries,**class_info))
-        result = cur.fetchone()
-        if result:
-            data[-1].update(result)
-            data[-1]['method'] = 'courseAndProf'
-            continue 
-
-        # If we still failed for the same prof and same course, look at only one or the other
-        cur.execute("""SELECT {summaries} FROM ClassSummaries WHERE 
-                            Professor={Professor}
-                        GROUP BY
-                            Professor"""
-                            .format(summaries=summaries,**class_info))
-        result_prof = cur.fetchone()
-        cur.execute("""SELECT {summaries} FROM ClassSummaries WHERE 
-                                    Course={Department}-{Code},
-                                GROUP BY
-                                    Course"""
-                                    .format(summaries=summaries,**class_info))
-        result_course = cur.fetchone()
-        if result_prof and result_course:
+        found = matches[crn]
+        if 'perfect' in found or 'courseAndProf' in found:
+            method = 'perfect' if 'perfect' in found else 'courseAndProf'
+            result = found[method]
+        elif 'prof' in found and 'course' in found:
             #!! avg somehow, for now just use course
-            data[-1].update(result_course)
-            data[-1]['method'] = 'courseOrProf'
-        elif result_course:
-            data[-1].update(result_course)
-            data[-1]['method'] = 'course'
-        elif result_prof:
-            data[-1].update(result_prof)
-            data[-1]['method'] = 'prof'
-        else: 
-            data[-1]['method'] = 'none'
+            method, result = 'courseOrProf', found['course']
+        elif 'course' in found or 'prof' in found:
+            method = 'course' if 'course' in found else 'prof'
+            result = found[method]
+        else:
+            method, result = 'none', {}
+
+        data[-1].update((col, result[col]) for col in result
+                            if col in out_cols or col[:-2] in out_cols)
+        data[-1]['method'] = method
 
     return data
 
+# Predictions for many classes at once: crns (and optionally cols, the averages to
+# predict, by default all of them) as comma separated url parameters, or lists in a
+# posted json object
+@app.route("/predict", methods=['GET', 'POST'])
+def predict():
+    if request.method == 'POST':
+        body = request.get_json(force=True)
+        crns, cols = body.get('crns', []), body.get('cols')
+    else:
+        crns = request.args.get('crns', '').split(',')
+        cols = request.args['cols'].split(',') if request.args.get('cols') else None
+
+    try:
+        crns = [int(crn) for crn in crns if unicode(crn).strip()]
+    except ValueError:
+        return "CRNs must be numbers", 400
+    if len(crns) > 1000:
+        return "At most 1000 CRNs at once", 400
+
+    db = get_db()
+    version, total = summaries_state(db)
+    schema = schemas.get(db, version)
+    avg_cols = [schema.col_names[idx] for idx in schema.avg_col_idxs]
+    cols = cols or avg_cols
+    if set(cols) - set(avg_cols):
+        return "Unknown columns: {}".format(",".join(set(cols) - set(avg_cols))), 400
 
+    return Response(json.dumps(predict_for_crns(db, schema, crns, cols), default=float),
+                    mimetype='application/json')
 
 if __name__ == '__main__':
         app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,169 @@
+from DataTables import DataTablesServer
+from MySQLdb import cursors
+import numpy as np
+
+# In-memory alternative to answering DataTables requests with MySQL. ClassSummaries is
+# small enough to keep in RAM as one NumPy array per column, so grouping, weighted
+# averages, searching, sorting and paging are all vectorized array operations.
+# Enabled with "engine: memory" in database.cfg.
+
+# MySQL's default collation compares strings ignoring case and trailing spaces, and
+# sorts NULL first
+def collation_key(value):
+    if value is None:
+        return (0, value)
+    elif isinstance(value, basestring):
+        return (2, value.lower().rstrip(' '))
+    return (1, value)
+
+# Dictionary encode a column: codes are ranks in collation order, so they sort and
+# group like MySQL does, and values holds the first value seen for each code
+def encode(column):
+    keys = [collation_key(value) for value in column]
+    ranks = {key: rank for rank, key in enumerate(sorted(set(keys)))}
+    codes = np.fromiter((ranks[key] for key in keys), dtype=np.int64, count=len(keys))
+
+    values = [None]*len(ranks)
+    seen = [False]*len(ranks)
+    for value, code in zip(column, codes):
+        if not seen[code]:
+            values[code] = value
+            seen[code] = True
+    return codes, values
+
+# ClassSummaries averages and counts are strings, empty for classes without the question
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+class SummaryArrays(object):
+    def __init__(self, rows, col_names):
+        self.size = len(rows)
+        self.codes = {}
+        self.values = {}
+        self.numbers = {}
+
+        names = set(col_names)
+        for name in col_names:
+            column = [row[name] for row in rows]
+            if name[-2:] == '_N' or name+'_N' in names:
+                self.numbers[name] = np.array([to_float(value) for value in column], dtype=np.float64)
+            elif name != 'SearchText':
+                self.codes[name], self.values[name] = encode(column)
+
+        # Lowercased for case insensitive substring search
+        self.search_text = np.array([(row.get('SearchText') or u'').lower() for row in rows],
+                                    dtype=np.unicode_)
+
+    @classmethod
+    def load(cls, db):
+        cursor = db.cursor(cursors.DictCursor)
+        cursor.execute("SELECT * FROM ClassSummaries")
+        rows = cursor.fetchall()
+        return cls(rows, [desc[0] for desc in cursor.description])
+
+# DataTablesServer answering from SummaryArrays instead of MySQL. Requests are read and
+# results returned the same way, so only the queries are replaced.
+class MemoryDataTablesServer(DataTablesServer):
+    def __init__(self, request, index, table, arrays, cache=None, version=None):
+        self.arrays = arrays
+        self.groups = None
+        self.aggregates = {}
+        DataTablesServer.__init__(self, request, index, table, None, cache, version=version)
+
+    # Rows matching every search word, like filtering
+    def row_mask(self):
+        mask = np.ones(self.arrays.size, dtype=bool)
+        for word in self.search_words():
+            mask &= np.char.find(self.arrays.search_text, word.lower()) >= 0
+        return mask
+
+    # (rows, group of each row, number of groups, first row of each group)
+    def grouped(self):
+        if self.groups is None:
+            rows = np.flatnonzero(self.row_mask())
+            group_cols = self.group_columns() or []
+            if not group_cols:
+                # Without GROUP BY, the aggregates are one row even if nothing matched
+                self.groups = (rows, np.zeros(len(rows), dtype=np.int64), 1, rows[:1])
+            elif not len(rows):
+                self.groups = (rows, rows, 0, rows)
+            else:
+                keys = np.stack([self.arrays.codes[name][rows] for name in group_cols], axis=1)
+                unique, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+                self.groups = (rows, inverse, len(unique), rows[first])
+        return self.groups
+
+    # Per group values of a column, NaN for NULL
+    def aggregate(self, name):
+        if name not in self.aggregates:
+            rows, inverse, count, first = self.grouped()
+            kind = self.column_kind(name)
+            if kind == 'param':
+                values = self.arrays.codes[name][first].astype(np.float64)
+            elif kind == 'sum' or kind == 'avg':
+                samples = np.nan_to_num(self.arrays.numbers[name if kind == 'sum' else name+'_N'][rows])
+                totals = np.bincount(inverse, weights=samples, minlength=count).astype(np.float64)
+                if kind == 'sum':
+                    values = totals
+                else:
+                    weighted = np.bincount(inverse, minlength=count,
+                                           weights=np.nan_to_num(self.arrays.numbers[name][rows])*samples)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        values = weighted / totals
+                    values[totals == 0] = np.nan
+                if not len(rows): # SUM of nothing is NULL
+                    values[:] = np.nan
+            else:
+                values = np.zeros(count)
+            self.aggregates[name] = values
+        return self.aggregates[name]
+
+    # Groups in the order of order_keys, nulls placed like MySQL
+    def sorted_groups(self):
+        sort_keys = []
+        for term, name, order_dir, nulls_last in self.order_keys():
+            values = self.aggregate(name)
+            if order_dir == 'desc':
+                values = -values
+            sort_keys.append(np.where(np.isnan(values), np.inf if nulls_last else -np.inf, values))
+        count = self.grouped()[2]
+        if not sort_keys:
+            return np.arange(count)
+        # lexsort sorts by the last key first
+        return np.lexsort(sort_keys[::-1])
+
+    def run_queries(self):
+        order = self.sorted_groups()
+        if ( self.req_data['start'] != "" ) and ( self.req_data['length'] != -1 ):
+            order = order[self.req_data['start']:self.req_data['start'] + self.req_data['length']]
+
+        first = self.grouped()[3]
+        rows = [{} for _ in order]
+        for name in self.column_names:
+            kind = self.column_kind(name)
+            if kind == 'hidden':
+                values = [""]*len(order)
+            elif kind == 'param':
+                codes = self.arrays.codes[name][first[order]]
+                values = [self.arrays.values[name][code] for code in codes]
+            else:
+                values = [None if np.isnan(value) else float(value) for value in self.aggregate(name)[order]]
+            for row, value in zip(rows, values):
+                row[name] = value
+        return rows
+
+    def count_filtered(self):
+        return self.grouped()[2]
+
+    def count_total(self):
+        return self.arrays.size
+
+    # Cursors are only an optimization for MySQL, offsets are just as fast here
+    def next_cursor(self):
+        return None
+
+    def cursor_anchor(self):
+        return None
@@ -0,0 +1,80 @@
+from MySQLdb import OperationalError
+import threading
+import Queue
+import time
+
+class PoolTimeout(Exception):
+    pass
+
+# Fixed size pool of MySQL connections shared by every request, so a page view doesn't
+# pay for connecting. Connections are made as needed up to size. One that has sat idle
+# for check_after seconds is pinged before it's handed out, and replaced if it's dead.
+class ConnectionPool(object):
+    def __init__(self, connect, size=8, timeout=10.0, check_after=30.0):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+
+        self.lock = threading.Lock()
+        self.idle = Queue.LifoQueue() # (connection, time returned), most recent first
+        self.created = 0
+
+    def get(self):
+        try:
+            con, returned = self.idle.get_nowait()
+        except Queue.Empty:
+            con = self.new_connection()
+            if con:
+                return con
+            try:
+                con, returned = self.idle.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise PoolTimeout("No connection free after {}s".format(self.timeout))
+
+        if time.time() - returned > self.check_after and not self.healthy(con):
+            self.discard(con)
+            return self.get()
+        return con
+
+    # Give a connection back. Its transaction is ended, so the next request sees data
+    # committed since, like new summaries.
+    def put(self, con):
+        try:
+            con.rollback()
+        except OperationalError:
+            self.discard(con)
+            return
+        self.idle.put((con, time.time()))
+
+    # A new connection if the pool isn't full yet, otherwise None
+    def new_connection(self):
+        with self.lock:
+            if self.created >= self.size:
+                return None
+            self.created += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def healthy(self, con):
+        try:
+            con.ping()
+            return True
+        except OperationalError:
+            return False
+
+    def discard(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.created -= 1
+
+    def stats(self):
+        with self.lock:
+            return {'size': self.size, 'connections': self.created, 'idle': self.idle.qsize()}
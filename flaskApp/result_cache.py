@@ -0,0 +1,81 @@
+from collections import OrderedDict
+import threading
+import time
+import sys
+
+# Rough deep size in bytes of query results: lists and dicts of rows of plain values
+def approx_size(value):
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approx_size(key) + approx_size(val)
+                                          for key, val in value.items())
+    elif isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(approx_size(item) for item in value)
+    return sys.getsizeof(value)
+
+# LRU cache of DataTables query results, bounded by entry count and approximate memory.
+# Entries expire after ttl seconds. Keys start with the summaries version the results
+# were read from, so they're never served for another one, and everything is dropped
+# when a newer version is seen (see set_version).
+class ResultCache(object):
+    def __init__(self, max_entries=256, max_bytes=64*1024*1024, ttl=600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (expires, size, value), least recent first
+        self.bytes = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Drop everything if the summaries have been rebuilt since the last call. A request
+    # still on an older version doesn't clear the newer one's results.
+    def set_version(self, version):
+        with self.lock:
+            if version != self.version and (self.version is None or version > self.version):
+                self.entries.clear()
+                self.bytes = 0
+                self.version = version
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            # Move to the most recent end
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value):
+        size = approx_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (time.time() + self.ttl, size, value)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    # Call with the lock held
+    def remove(self, key):
+        expires, size, value = self.entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': float(self.hits)/lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'entries': len(self.entries),
+                    'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'version': self.version}
@@ -0,0 +1,69 @@
+from MySQLdb import cursors, ProgrammingError
+import threading
+import json
+
+# Column layout of ClassSummaries and everything derived from it: the index page's
+# column definitions and its rollup tables (see Database.build_rollups). It only
+# changes when the summaries are rebuilt.
+class SummarySchema(object):
+    def __init__(self, col_names, rollups, visible_cols):
+        self.col_names = col_names
+        self.rollups = rollups
+
+        names = set(col_names)
+        self.sample_col_idxs = [idx for idx,name in enumerate(col_names) if name[-2:] == '_N']
+        self.avg_col_idxs = [idx for idx,name in enumerate(col_names) if name+'_N' in names]
+        value_idxs = set(self.sample_col_idxs + self.avg_col_idxs)
+        self.param_col_idxs = [idx for idx in range(len(col_names)) if idx not in value_idxs]
+        self.init_order = [[self.avg_col_idxs[0], 'desc']] if self.avg_col_idxs else []
+        self.columns = [{"title": name,
+                         "name": name,
+                         # param cols are searchable, value cols aren't
+                         "searchable": idx not in value_idxs,
+                         "visible": name in visible_cols}
+                            for idx,name in enumerate(col_names)]
+
+        # index.html's arguments, rendered once
+        self.page_json = {'columns': json.dumps(self.columns),
+                          'sample_col_idxs': json.dumps(self.sample_col_idxs),
+                          'avg_col_idxs': json.dumps(self.avg_col_idxs),
+                          'param_col_idxs': json.dumps(self.param_col_idxs),
+                          'init_order': json.dumps(self.init_order)}
+
+    # Name of the rollup grouped by exactly cols, or None if there isn't one
+    def rollup_table(self, cols):
+        for name, group_cols in self.rollups:
+            if group_cols == set(cols):
+                return name
+        return None
+
+    @classmethod
+    def load(cls, db, visible_cols):
+        cursor = db.cursor(cursors.DictCursor)
+        cursor.execute("DESCRIBE ClassSummaries")
+        # SearchText only backs the search box, see DataTablesServer.filtering
+        col_names = [entry['Field'] for entry in cursor.fetchall() if entry['Field'] != 'SearchText']
+
+        try:
+            cursor.execute("SELECT TableName,GroupCols FROM SummaryRollups")
+            rollups = [(row['TableName'], set(row['GroupCols'].split(","))) for row in cursor.fetchall()]
+        except ProgrammingError: # Summaries built before rollups
+            rollups = []
+
+        return cls(col_names, rollups, visible_cols)
+
+# Something derived from ClassSummaries, like its SummarySchema, kept until the
+# summaries version changes. load(db) makes a new one.
+class PerVersion(object):
+    def __init__(self, load):
+        self.load = load
+        self.lock = threading.Lock()
+        self.version = object()
+        self.value = None
+
+    def get(self, db, version):
+        with self.lock:
+            if self.value is None or version != self.version:
+                self.value = self.load(db)
+                self.version = version
+            return self.value
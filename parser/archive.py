@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+import os
+import gzip
+import hashlib
+import threading
+
+# Content-addressed store of raw evaluation pages, so they can be re-parsed without
+# going back to bannerweb.
+#
+# Pages are stored gzipped under objects/ by the sha1 of their contents, so identical
+# pages are only stored once. index.tsv maps each class to the hash of its page, one
+# line per download: AcademicYear, ADLN, CRN, hash, url. The index is only ever
+# appended to, and later lines win when it's loaded.
+class EvalArchive(object):
+    index_name = 'index.tsv'
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.index = {}
+
+        if not os.path.isdir(os.path.join(root, 'objects')):
+            os.makedirs(os.path.join(root, 'objects'))
+
+        index_path = os.path.join(root, self.index_name)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    year, adln, crn, digest, url = line.rstrip('\n').split('\t')
+                    self.index[(year, adln=='1', crn, url)] = digest
+
+        self.index_file = open(index_path, 'a')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return self.key(*key) in self.index
+
+    # Normalize key parts, since years and crns come from both urls and the db
+    @staticmethod
+    def key(year, adln, crn, url):
+        return (str(year), bool(adln), str(crn), url)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest[2:] + '.html.gz')
+
+    # Store page text (unicode) for a class, returns its hash
+    def put(self, year, adln, crn, url, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.object_path(digest)
+
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError: # Another thread made it first
+                    pass
+            # Write to a temp file first so a crash can't leave a truncated object
+            tmp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+            with gzip.open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+
+        key = self.key(year, adln, crn, url)
+        with self.lock:
+            if self.index.get(key) != digest:
+                self.index[key] = digest
+                self.index_file.write('\t'.join([key[0], '1' if key[1] else '0', key[2], digest, url]) + '\n')
+                self.index_file.flush()
+
+        return digest
+
+    # Return the page text stored for a class, or None if it isn't archived
+    def get(self, year, adln, crn, url):
+        digest = self.index.get(self.key(year, adln, crn, url))
+        if digest is None:
+            return None
+        return self.read(digest)
+
+    def read(self, digest):
+        with gzip.open(self.object_path(digest), 'rb') as f:
+            return f.read().decode('utf-8')
+
+    # Yield (url, crn, year, adln, digest) for every archived class, grouped by year
+    def entries(self):
+        for key in sorted(self.index):
+            year, adln, crn, url = key
+            yield url, crn, year, adln, self.index[key]
+
+    def close(self):
+        self.index_file.close()
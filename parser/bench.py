@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+# End-to-end benchmark of the ingest path: downloads every class of a year from a
+# local mock bannerweb (see mock_bannerweb.py) serving generated pages (evalgen.py),
+# parses and stores them with process_evals, and reports pages per second, latency
+# percentiles for the download, parse and store stages, and peak memory.
+#
+# bench.py [-n CLASSES[,CLASSES...]] [-j WORKERS] [-P PROCESSES] [-p bs4|lxml] [-l LATENCY] [-d]
+#
+# Each size in -n is a separate run, e.g. -n 1000,10000,100000.
+# Stores go to a sink that throws them away unless -d is given, which resets the
+# configured database (see eval_db.py) and stores into it. Stage latencies come from
+# parser.py's metrics, store latencies are per batch.
+
+from __future__ import print_function
+from mock_bannerweb import MockBannerweb
+from ratelimit import AdaptiveRateLimiter
+from eval_db import Database
+from metrics import metrics
+import parser
+import multiprocessing
+import resource
+import getopt
+import time
+import sys
+import os
+
+year = 2016
+
+# Stand-in for Database that drops everything stored
+class NullDatabase(object):
+    def __init__(self):
+        self.ids = None
+
+    def source_hashes(self, years):
+        return set()
+
+    def store(self, obj):
+        pass
+
+    def store_many(self, evaluations, batch_size=500):
+        return []
+
+# Peak resident set size in MB of this process and of its children (parse processes)
+def peak_rss():
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_kb/1024.0, children_kb/1024.0
+
+def serve(settings, urls):
+    server = MockBannerweb(**settings)
+    urls.put(server.url)
+    server.serve_forever()
+
+# One benchmark run, in its own process so peak memory is just this run's
+def run(classes, workers, processes, parse_name, use_db, url, results):
+    parser.use_server(url)
+    sys.stdout = open(os.devnull, 'w') # process_evals' progress output
+
+    # Don't let the rate limiter be what's measured
+    limiter = AdaptiveRateLimiter(rate=1e6, max_rate=1e6, burst=1000)
+    dl = parser.Downloader('bench', 'bench', limiter=limiter)
+    dl.login()
+
+    if use_db:
+        db = Database()
+        db.reset()
+    else:
+        db = NullDatabase()
+
+    metrics.reset()
+    start = time.time()
+    parser.process_evals(db, dl, year, adln=False, workers=workers,
+                         parse=parser.parsers[parse_name], processes=processes)
+    elapsed = time.time() - start
+
+    results.put({'classes': classes, 'elapsed': elapsed, 'metrics': metrics.to_dict(),
+                 'rss': peak_rss()})
+
+def report(result):
+    print("{classes} classes in {elapsed:.1f}s, {rate:.1f} pages/s".format(
+            rate=result['classes']/result['elapsed'], **result))
+    print("  {:9} {:>8} {:>9} {:>9} {:>9} {:>9}".format('stage', 'count', 'p50 ms', 'p90 ms',
+                                                        'p99 ms', 'max ms'))
+    for name in ['download', 'parse', 'store']:
+        hist = result['metrics']['histograms'].get(name)
+        if not hist:
+            print("  {:9} {:>8}".format(name, 'n/a'))
+            continue
+        print("  {:9} {:8d} {:9.2f} {:9.2f} {:9.2f} {:9.2f}".format(name, hist['count'],
+                *[hist[key]*1000 for key in ['p50', 'p90', 'p99', 'max']]))
+    print("  downloaded {:.1f} MB, stored {} classes".format(
+            result['metrics']['counters'].get('download_bytes', 0)/1e6,
+            result['metrics']['counters'].get('classes_stored', 0)))
+    print("  peak RSS: {:.1f} MB, parse processes {:.1f} MB".format(*result['rss']))
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "n:j:P:p:l:d")
+    except getopt.GetoptError:
+        print("bench.py [-n CLASSES[,CLASSES...]] [-j WORKERS] [-P PROCESSES] [-p bs4|lxml] "
+              "[-l LATENCY] [-d]")
+        return 2
+
+    sizes = [1000]
+    workers = 1
+    processes = 1
+    parse_name = 'bs4'
+    latency = 0.0
+    use_db = False
+    for opt, arg in opts:
+        if opt == '-n':
+            sizes = [int(size) for size in arg.split(',')]
+        elif opt == '-j':
+            workers = int(arg)
+        elif opt == '-P':
+            processes = int(arg)
+        elif opt == '-p':
+            parse_name = arg
+        elif opt == '-l':
+            latency = float(arg)
+        elif opt == '-d':
+            use_db = True
+
+    if use_db:
+        print("Warning: -d resets the configured database")
+
+    print("{} parser, {} workers, {} processes, {:.0f}ms server latency".format(
+            parse_name, workers, processes, latency*1000))
+
+    for classes in sizes:
+        urls = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve,
+                                         args=({'classes': classes, 'latency': latency}, urls))
+        server.daemon = True
+        server.start()
+        try:
+            results = multiprocessing.Queue()
+            bench = multiprocessing.Process(target=run, args=(classes, workers, processes,
+                                                              parse_name, use_db, urls.get(),
+                                                              results))
+            bench.start()
+            bench.join()
+            if bench.exitcode:
+                print("Run of {} classes failed".format(classes))
+                return 1
+            report(results.get())
+        finally:
+            server.terminate()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+# Checks that downloads survive a flaky bannerweb: runs process_evals against a local
+# mock bannerweb (see mock_bannerweb.py) and checks every class was stored with no
+# FailedScrapes. Exits 1 if not. There are two scenarios, both run unless -s picks one:
+#   flaky: some eval pages fail with 503s and sessions expire. They should be retried,
+#          logging in again when sessions expired.
+#   slow:  every eval page is slower than the rate limiter's target latency, and some
+#          hang past the Downloader's timeout. The default AdaptiveRateLimiter should
+#          back off, and the pages that timed out should be retried.
+#
+# check_mock.py [-s flaky|slow] [-n CLASSES] [-j WORKERS] [-P PROCESSES] [-e ERROR_RATE] [-x EXPIRE_EVERY]
+#               [-r RETRIES] [-l LATENCY] [-t TIMEOUT_RATE] [-T TIMEOUT]
+#
+# Retries back off like they do against the real site, so this takes a little while,
+# and the slow scenario takes a minute or two since the limiter slows right down. -n
+# defaults to 200 classes for flaky and 10 for slow.
+# The Downloader gets more retries than its default, since at a 20% error rate about one
+# page in 3000 fails every one of the default 5 tries, which isn't what's being checked.
+
+from __future__ import print_function
+from mock_bannerweb import MockBannerweb
+from ratelimit import AdaptiveRateLimiter
+from eval_db import FailedScrape
+from metrics import metrics
+import parser
+import getopt
+import time
+import sys
+import os
+
+year = 2016
+
+# Stand-in for Database that keeps what's stored
+class RecordingDatabase(object):
+    def __init__(self):
+        self.ids = None
+        self.evaluations = []
+        self.failures = []
+
+    def source_hashes(self, years):
+        return set()
+
+    def store(self, obj):
+        if isinstance(obj, FailedScrape):
+            self.failures.append(obj)
+        else:
+            self.evaluations.append(obj)
+
+    def store_many(self, evaluations, batch_size=500):
+        self.evaluations += evaluations
+        return []
+
+# Download a year from server into a RecordingDatabase with dl.
+# Returns the database and the seconds it took.
+def run(server, dl, workers, processes):
+    parser.use_server(server.url)
+    db = RecordingDatabase()
+    metrics.reset()
+    start = time.time()
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w') # process_evals' progress output
+    try:
+        parser.process_evals(db, dl, year, adln=False, workers=workers, processes=processes)
+    finally:
+        sys.stdout = stdout
+    return db, time.time() - start
+
+# Problems common to every scenario, after printing what happened
+def report(server, db, classes, elapsed):
+    stats = server.stats
+    print("{} classes in {:.1f}s: {} stored, {} failed".format(classes, elapsed, len(db.evaluations),
+                                                                 len(db.failures)))
+    print("  server: {errors} errors, {timeouts} timeouts, {expired} sessions expired, "
+          "{logins} logins".format(**stats))
+    print("  client: {} retries".format(retried()))
+
+    problems = []
+    for failure in db.failures:
+        problems.append("CRN {} failed: {}".format(failure.CRN, failure.Reason))
+    if len(db.evaluations) != classes:
+        problems.append("stored {} of {} classes".format(len(db.evaluations), classes))
+    return problems
+
+def retried():
+    return metrics.to_dict()['counters'].get('retries', 0)
+
+def check_flaky(classes, workers, processes, error_rate, expire_every, retries):
+    print("flaky:")
+    server = MockBannerweb(classes=classes, error_rate=error_rate, expire_every=expire_every).start()
+    try:
+        limiter = AdaptiveRateLimiter(rate=1e6, max_rate=1e6, burst=1000)
+        dl = parser.Downloader('check', 'check', limiter=limiter, retries=retries)
+        db, elapsed = run(server, dl, workers, processes)
+    finally:
+        server.stop()
+
+    stats = server.stats
+    problems = report(server, db, classes, elapsed)
+    if error_rate and stats['errors'] and not retried():
+        problems.append("server errors weren't retried")
+    if expire_every and not stats['expired']:
+        problems.append("no session expired, use fewer pages per session (-x)")
+    if stats['logins'] <= stats['expired']:
+        problems.append("didn't log in again after every expired session")
+    return problems
+
+def check_slow(classes, workers, processes, latency, timeout_rate, timeout, retries):
+    print("slow:")
+    # Hung pages outlast the timeout by plenty, so they can only succeed by being retried.
+    # Seeded so the first 10 pages include some that hang at the default timeout rate.
+    server = MockBannerweb(classes=classes, latency=latency, timeout_rate=timeout_rate,
+                          timeout_delay=latency + 3*timeout, seed=1).start()
+    try:
+        limiter = AdaptiveRateLimiter()
+        start_rate = limiter.rate
+        dl = parser.Downloader('check', 'check', limiter=limiter, retries=retries, timeout=timeout)
+        db, elapsed = run(server, dl, workers, processes)
+    finally:
+        server.stop()
+
+    stats = server.stats
+    problems = report(server, db, classes, elapsed)
+    print("  limiter: rate {:.2f} -> {:.2f} per second".format(start_rate, limiter.rate))
+    if not limiter.rate < start_rate:
+        problems.append("rate limiter didn't back off")
+    if timeout_rate and not stats['timeouts']:
+        problems.append("no page timed out, use more classes (-n) or a higher timeout rate (-t)")
+    if retried() < stats['timeouts']:
+        problems.append("timed out pages weren't all retried")
+    return problems
+
+def main(argv):
+    usage = ("check_mock.py [-s flaky|slow] [-n CLASSES] [-j WORKERS] [-P PROCESSES] [-e ERROR_RATE] "
+             "[-x EXPIRE_EVERY] [-r RETRIES] [-l LATENCY] [-t TIMEOUT_RATE] [-T TIMEOUT]")
+    try:
+        opts, args = getopt.getopt(argv, "s:n:j:P:e:x:r:l:t:T:")
+    except getopt.GetoptError:
+        print(usage)
+        return 2
+
+    scenarios = ['flaky', 'slow']
+    classes = None
+    workers = 4
+    processes = 1
+    error_rate = 0.2
+    expire_every = 30
+    retries = 8
+    # Over the default limiter's 2 second target latency, under the timeout
+    latency = 2.5
+    timeout_rate = 0.2
+    timeout = 4.0
+    for opt, arg in opts:
+        if opt == '-s':
+            if arg not in scenarios:
+                print(usage)
+                return 2
+            scenarios = [arg]
+        elif opt == '-n':
+            classes = int(arg)
+        elif opt == '-j':
+            workers = int(arg)
+        elif opt == '-P':
+            processes = int(arg)
+        elif opt == '-e':
+            error_rate = float(arg)
+        elif opt == '-x':
+            expire_every = int(arg)
+        elif opt == '-r':
+            retries = int(arg)
+        elif opt == '-l':
+            latency = float(arg)
+        elif opt == '-t':
+            timeout_rate = float(arg)
+        elif opt == '-T':
+            timeout = float(arg)
+
+    problems = []
+    if 'flaky' in scenarios:
+        problems += check_flaky(classes or 200, workers, processes, error_rate, expire_every, retries)
+    if 'slow' in scenarios:
+        problems += check_slow(classes or 10, workers, processes, latency, timeout_rate, timeout, retries)
+    for problem in problems:
+        print(problem)
+    print("FAILED" if problems else "OK")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# Check that the parse_eval engines agree, and benchmark them.
+# Runs every engine over the pages in an archive (see parser.py -a) or a list of html
+# files, reports any page where an engine's result differs from bs4's, and prints
+# pages parsed per second for each engine. Given neither, it uses PAGES (default 100)
+# synthetic pages from evalgen.py, so the engines can be compared without any
+# downloaded pages.
+#
+# compare_parsers.py [-a ARCHIVE_DIR | FILE... | -n PAGES]
+
+from __future__ import print_function
+from parser import parsers, ParseError
+from archive import EvalArchive
+from evalgen import eval_page
+import io
+import sys
+import time
+import getopt
+
+# Comparable form of an Evaluation: everything stored, as unicode
+def eval_to_dict(ev):
+    def fields(obj, blacklist):
+        return {key: unicode(val, 'utf-8') if isinstance(val, str) else unicode(val)
+                    for key,val in obj.__dict__.items() if key not in blacklist}
+
+    result = fields(ev, ['questions'])
+    result['questions'] = [(fields(q, ['answers']), [fields(a, []) for a in q.answers])
+                                for q in ev.questions]
+    return result
+
+def parse_all(parse, pages):
+    results = []
+    for text in pages:
+        try:
+            results.append(eval_to_dict(parse(text)))
+        except ParseError as e:
+            results.append(ParseError)
+    return results
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "a:n:")
+    except getopt.GetoptError:
+        print("compare_parsers.py [-a ARCHIVE_DIR | FILE... | -n PAGES]")
+        return 2
+
+    pages = []
+    generated = 100
+    read_pages = False
+    for opt, arg in opts:
+        if opt == '-a':
+            archive = EvalArchive(arg)
+            pages += [archive.read(entry[4]) for entry in archive.entries()]
+            read_pages = True
+        elif opt == '-n':
+            generated = int(arg)
+    for path in args:
+        with io.open(path, encoding='utf-8') as f:
+            pages.append(f.read())
+        read_pages = True
+
+    if not read_pages:
+        # Decoded, like the pages Downloader returns
+        pages = [eval_page(crn, 2016, crn).decode('utf-8') for crn in range(10000, 10000 + generated)]
+
+    if not pages:
+        print("No pages to parse")
+        return 2
+
+    results = {}
+    for name in sorted(parsers):
+        start = time.time()
+        results[name] = parse_all(parsers[name], pages)
+        elapsed = time.time() - start
+        print("{:6} {:6d} pages in {:7.2f}s, {:8.1f} pages/s".format(
+                name, len(pages), elapsed, len(pages)/elapsed))
+
+    mismatches = 0
+    for name in sorted(parsers):
+        for idx, (expected, actual) in enumerate(zip(results['bs4'], results[name])):
+            if expected != actual:
+                mismatches += 1
+                print("{} differs from bs4 on page {}:\n  bs4: {}\n  {}: {}".format(
+                        name, idx, expected, name, actual))
+
+    print("{} mismatches".format(mismatches))
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -6,6 +6,29 @@ import ConfigParser
 #!! Check commit places
 
 class Database(object):
+    # Grouping sets that get a precomputed rollup of ClassSummaries, for the common
+    # views of the site and its predictions (see build_rollups)
+    rollup_groupings = [['Instructor'], ['Course'], ['Instructor','Course'],
+                        ['Department','AcademicYear'], ['AcademicYear','Instructor','Course'],
+                        ['Course','Name','Instructor']]
+
+    # Bumped when the SearchText index is made differently, so incremental builds, which
+    # copy the live index, rebuild ClassSummaries once instead
+    search_index_version = 2
+
+    # Secondary indexes as (table, columns), made by apply_indexes. The summary tables are
+    # indexed on the columns the site groups by and looks classes up by, and each rollup
+    # on its grouping (see index_spec). Their sorts are on aggregates, which no index helps.
+    indexes = [('Classes', ['AcademicYear','ADLN','CRN']),       # validate_and_fix
+               ('Classes', ['AcademicYear','SourceHash']),       # unchanged page hashes
+               ('FailedScrapes', ['AcademicYear','ADLN','CRN']), # validate_and_fix
+               ('AnswerFields', ['ClassID','QuestionID','Weight','Respondents']), # QuestionAvgs
+               ('ClassSummaries', ['CRN','AcademicYear','Instructor']), # incremental builds
+               ('ClassSummaries', ['AcademicYear','Instructor','Course']),
+               ('ClassSummaries', ['Instructor','Course']),
+               ('ClassSummaries', ['Course','Name','Instructor']),
+               ('ClassSummaries', ['Department','AcademicYear'])]
+
     def __init__(self, **kwargs):
         # Database info can be passed in as arguments, or read from cfg file
         if kwargs:
@@ -21,10 +44,163 @@ class Database(object):
                                    passwd = opt['password'])
 
         self.cur = self.con.cursor(mdb.cursors.DictCursor)
+        self.upgrade_schema()
+
+        self.ids = IDCache()
+        try:
+            self.ids.warm(self.cur)
+        except mdb.ProgrammingError:
+            # Tables don't exist yet, reset() will warm the cache
+            pass
+
+    # Columns added to tables after they were first made, as (table, column, definition).
+    # reset() makes them with the tables, upgrade_schema adds them to older databases.
+    def added_columns(self):
+        return [('Classes', 'SourceHash', 'CHAR(40)'),
+                ('FailedScrapes', 'Reason', 'VARCHAR({})'.format(FailedScrape.reason_length))]
+
+    def upgrade_schema(self):
+        for table, column, definition in self.added_columns():
+            try:
+                self.cur.execute("SHOW COLUMNS FROM {} LIKE %s".format(table), column)
+            except mdb.ProgrammingError: # Table doesn't exist yet
+                continue
+            if self.cur.fetchone() is None:
+                self.cur.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
 
     def store(self, obj):
-        obj.store(self.cur)
+        try:
+            obj.store(self.cur, self.ids)
+        except mdb.DatabaseError:
+            # Don't leave a partly stored object to be committed with the next one
+            self.rollback()
+            raise
+        self.commit()
+
+    def commit(self):
         self.con.commit()
+        self.ids.commit()
+
+    def rollback(self):
+        self.con.rollback()
+        self.ids.rollback()
+
+    # Store many Evaluations using a few multi-row statements per batch instead of
+    # a round trip per row, committing once per batch.
+    # Returns a list of (evaluation, error) for the classes that couldn't be stored.
+    def store_many(self, evaluations, batch_size=500):
+        failures = []
+        for start in range(0, len(evaluations), batch_size):
+            batch = evaluations[start:start+batch_size]
+            try:
+                failures += self.store_batch(batch)
+                self.commit()
+            except mdb.DatabaseError:
+                # Something we didn't check for beforehand. Fall back to storing classes
+                # one at a time to find out which ones are bad. They still go through
+                # store_batch, so changed pages replace their stored class.
+                self.rollback()
+                for ev in batch:
+                    try:
+                        failures += self.store_batch([ev])
+                        self.commit()
+                    except mdb.DatabaseError as e:
+                        self.rollback()
+                        failures.append((ev, e))
+        return failures
+
+    # Evaluations with a SourceHash that are already stored are updated in place, with
+    # their AnswerFields replaced, since their page has changed. Other duplicates fail.
+    def store_batch(self, evaluations):
+        failures = []
+
+        # Classes that break uc_Class, either with the db or each other
+        crns = list(set(ev.CRN for ev in evaluations))
+        self.cur.execute("SELECT ClassID,CRN,AcademicYear,Instructor FROM Classes WHERE CRN IN ({})"
+                            .format(",".join(["%s"]*len(crns))), crns)
+        stored = {Evaluation.unique_key(row): row['ClassID'] for row in self.cur.fetchall()}
+        seen = set()
+
+        evs = []
+        replaced = {}
+        for ev in evaluations:
+            key = Evaluation.unique_key(ev.__dict__)
+            error = None
+            if key in seen or (key in stored and not hasattr(ev, 'SourceHash')):
+                error = "Duplicate entry {} for key 'uc_Class'".format(key)
+            elif ev.has_duplicate_answers():
+                error = "Duplicate entry for key 'uc_AnswerField'"
+
+            if error:
+                failures.append((ev, mdb.IntegrityError(1062, error)))
+                continue
+            seen.add(key)
+            if key in stored:
+                replaced[id(ev)] = stored[key]
+            evs.append(ev)
+        if not evs:
+            return failures
+
+        for ev in evs:
+            if hasattr(ev, 'TermName'):
+                ev.TermID = self.ids.term_id(self.cur, ev.TermName)
+
+        # Insert new classes, grouped by which columns they have
+        by_cols = {}
+        for ev in evs:
+            if id(ev) not in replaced:
+                cols, vals = zip(*ev.fields())
+                by_cols.setdefault(cols, []).append(vals)
+        for cols, rows in by_cols.items():
+            self.cur.executemany("INSERT INTO Classes ({cols}) VALUES ({vals})"
+                                    .format(cols=",".join(cols), vals=",".join(["%s"]*len(cols))),
+                                 rows)
+
+        # Update changed classes, and clear out their old answers
+        for ev in evs:
+            if id(ev) in replaced:
+                cols, vals = zip(*ev.fields())
+                self.cur.execute("UPDATE Classes SET {} WHERE ClassID=%s"
+                                    .format(",".join(col+"=%s" for col in cols)),
+                                 vals + (replaced[id(ev)],))
+        if replaced:
+            replaced_ids = replaced.values()
+            self.cur.execute("DELETE FROM AnswerFields WHERE ClassID IN ({})"
+                                .format(",".join(["%s"]*len(replaced_ids))), replaced_ids)
+            # Let the next incremental summary build know they changed
+            self.cur.executemany("INSERT IGNORE INTO SummaryChanges (ClassID) VALUES (%s)",
+                                 [(class_id,) for class_id in replaced_ids])
+
+        # Read back the IDs of the classes we just inserted
+        if by_cols:
+            self.cur.execute("SELECT ClassID,CRN,AcademicYear,Instructor FROM Classes WHERE CRN IN ({})"
+                                .format(",".join(["%s"]*len(crns))), crns)
+            stored.update((Evaluation.unique_key(row), row['ClassID']) for row in self.cur.fetchall())
+
+        answer_rows = []
+        for ev in evs:
+            class_id = stored[Evaluation.unique_key(ev.__dict__)]
+            for question in ev.questions:
+                q_id = self.ids.question_id(self.cur, question)
+                for answer in question.answers:
+                    answer.QuestionID = q_id
+                    answer.ClassID = class_id
+                    answer_rows.append(tuple(answer.__dict__.get(col) for col in AnswerField.columns))
+
+        self.cur.executemany("INSERT INTO AnswerFields ({cols}) VALUES ({vals})"
+                                .format(cols=",".join(AnswerField.columns),
+                                        vals=",".join(["%s"]*len(AnswerField.columns))),
+                             answer_rows)
+        return failures
+
+    # Source page hashes of the classes stored for the given years, see Evaluation.SourceHash
+    def source_hashes(self, years):
+        years = list(years)
+        if not years:
+            return set()
+        self.cur.execute("SELECT SourceHash FROM Classes WHERE SourceHash IS NOT NULL AND AcademicYear IN ({})"
+                            .format(",".join(["%s"]*len(years))), years)
+        return set(row['SourceHash'] for row in self.cur.fetchall())
 
     def get_col_grouped_by(self, class_, col, groups):
         # Increase GROUP_CONCAT limit
@@ -45,7 +221,11 @@ class Database(object):
 
     def reset(self):
         #Clean database
-        self.cur.execute("DROP TABLE IF EXISTS AnswerFields,Classes,Terms,Questions,FailedScrapes")
+        self.cur.execute("DROP TABLE IF EXISTS AnswerFields,Classes,Terms,Questions,FailedScrapes,SummaryChanges")
+        # Everything but Version, which keeps counting up so every build's version is new
+        # to the site's caches
+        self.create_summary_tables()
+        self.cur.execute("DELETE FROM SummaryState WHERE Name <> 'Version'")
         self.cur.execute("DROP VIEW IF EXISTS QuestionAvgs")
 
         self.cur.execute("""CREATE TABLE Terms( 
@@ -78,9 +258,11 @@ class Database(object):
                         Section         VARCHAR(4), 
                         Instructor      VARCHAR(100), 
                         ADLN            BOOL, 
+                        SourceHash      CHAR(40),
                         CONSTRAINT uc_Class UNIQUE (CRN,AcademicYear,Instructor))""")
                         #AcademicYear- Year that started Jan or this course's academic year
                         #ADLN- Advanced Distance Learning Network course
+                        #SourceHash- sha1 of the eval page this was parsed from
 
         self.cur.execute("""CREATE TABLE Questions( 
                         QuestionID      INT PRIMARY KEY AUTO_INCREMENT, 
@@ -92,6 +274,8 @@ class Database(object):
         with open('questions.cvs') as f:
             self.load_questions_from_file(f)
 
+        self.ids.warm(self.cur)
+
         self.cur.execute("""CREATE TABLE AnswerFields( 
                         AnswerFieldID   INT PRIMARY KEY AUTO_INCREMENT, 
                         AnswerText      VARCHAR(50),
@@ -108,7 +292,10 @@ class Database(object):
                         FailedScrapeID  INT PRIMARY KEY AUTO_INCREMENT,
                         CRN             INT,
                         AcademicYear    YEAR,
-                        ADLN            BOOL)""")#!! unique
+                        ADLN            BOOL,
+                        Reason          VARCHAR({}))""".format(FailedScrape.reason_length))#!! unique
+
+        self.create_summary_tables()
 
         # Create view for average question answers, which is usually what we care about
         self.cur.execute("""CREATE VIEW QuestionAvgs AS
@@ -142,18 +329,265 @@ class Database(object):
         for line in lines[1:]:
             self.cur.execute("UPDATE Weight={1} FROM AnswerFields WHERE AnswerText='{0}'".format(*line.split(",")))#!! wrong, fix
 
-    # Build view with all of the columns DataTables might request
-    def build_class_summaries(self):
+    # Build table with all of the columns DataTables might request.
+    # If incremental, only add summaries for classes stored since the last build, unless
+    # the questions or rollups have changed. Otherwise rebuild the whole table.
+    # Incremental builds update the live tables in place in one transaction (see
+    # update_summaries), so they cost what changed rather than the whole history. Full
+    # builds make new summaries and rollups in shadow tables while the site keeps reading
+    # the old ones, then publish them all at once (see publish_summaries).
+    def build_class_summaries(self, incremental=False):
         # Get questions
         self.cur.execute("SELECT ShortString FROM Questions")
         short_strings = [row['ShortString'] for row in self.cur.fetchall()]
+
+        # Remember the newest class we're summarizing, so the next build can start there
+        self.create_summary_tables()
+        self.cur.execute("SELECT COALESCE(MAX(ClassID),0) AS LastClassID FROM Classes")
+        last_class_id = self.cur.fetchone()['LastClassID']
+        prev_class_id = self.get_summary_state('LastClassID')
+
+        # Classes whose pages changed since the last build (see store_batch)
+        self.cur.execute("SELECT ClassID FROM SummaryChanges")
+        changed_ids = [row['ClassID'] for row in self.cur.fetchall()]
+        changed_params = ",".join(["%s"]*len(changed_ids))
+
+        # Left by a build that failed partway
+        self.drop_build_tables()
+
+        # The ngram parser behind SearchText's index drops every piece containing a
+        # stopword, and the default list has "a" and "i". MySQL applies the setting when
+        # an index is made, which is when a full build makes the shadow table.
+        self.cur.execute("SET SESSION innodb_ft_enable_stopword = OFF")
+
+        full = not (incremental and prev_class_id is not None
+                    and self.summary_columns() == self.summary_columns(short_strings)
+                    and self.get_summary_state('SearchIndex') == self.search_index_version
+                    and self.built_groupings() == sorted(",".join(groups) for groups in self.rollup_groupings))
+        if full:
+            changed = True
+            shadow = self.shadow_table("ClassSummaries")
+            self.cur.execute("CREATE TABLE {} AS ".format(shadow) +
+                                self.class_summaries_select(short_strings))
+            # Index for the site's search box. The ngram parser indexes every 2 character
+            # piece of the text, so searches match within words, like course numbers.
+            # Stopwords are off, see above.
+            self.cur.execute("ALTER TABLE {} ADD FULLTEXT INDEX SummarySearch (SearchText) WITH PARSER ngram"
+                                .format(shadow))
+            self.build_rollups(short_strings, shadow)
+            self.apply_indexes(self.shadow_suffix)
+            self.publish_summaries()
+        else:
+            changed = bool(changed_ids) or last_class_id > prev_class_id
+            if changed:
+                class_filter = "ClassID > %s AND ClassID <= %s"
+                if changed_ids:
+                    class_filter = "({}) OR ClassID IN ({})".format(class_filter, changed_params)
+                added_rows = self.update_summaries(short_strings, class_filter,
+                                                   [prev_class_id, last_class_id] + changed_ids)
+
+        if changed_ids:
+            self.cur.execute("DELETE FROM SummaryChanges WHERE ClassID IN ({})".format(changed_params),
+                             changed_ids)
+        self.set_summary_state('LastClassID', last_class_id)
+        self.set_summary_state('SearchIndex', self.search_index_version)
+        # Tells the site its cached results are out of date
+        if changed:
+            if full:
+                self.cur.execute("SELECT COUNT(*) AS SummaryRows FROM ClassSummaries")
+                self.set_summary_state('SummaryRows', self.cur.fetchone()['SummaryRows'])
+                self.cur.execute("DELETE FROM SummaryRollups")
+                self.cur.executemany("INSERT INTO SummaryRollups (TableName,GroupCols) VALUES (%s,%s)",
+                                     [(self.rollup_table(groups), ",".join(groups)) for groups in self.rollup_groupings])
+            else:
+                self.set_summary_state('SummaryRows', (self.get_summary_state('SummaryRows') or 0) + added_rows)
+            self.set_summary_state('Version', (self.get_summary_state('Version') or 0) + 1)
+        self.con.commit()
+
+        # Every build, so databases made before an index was added get it too. This is
+        # also how reset makes them.
+        self.apply_indexes()
+        # Tables replaced by this build, and rollups that aren't built anymore, which were
+        # listed in SummaryRollups until the commit above
+        self.drop_build_tables()
+        self.drop_stale_rollups()
+
+    # Grouping sets of the rollups the last full build made, as sorted strings
+    def built_groupings(self):
+        self.cur.execute("SELECT GroupCols FROM SummaryRollups")
+        return sorted(row['GroupCols'] for row in self.cur.fetchall())
+
+    # Replace the summaries of the classes matching class_filter in the live ClassSummaries,
+    # and recompute the rollup groups they were or are now in. It's all DML, so it's
+    # committed with the rest of the build and the site sees none of it until then.
+    # Deleting first makes it safe to repeat for classes that already have summaries.
+    # Returns the change in the number of ClassSummaries rows.
+    def update_summaries(self, short_strings, class_filter, params):
+        key_cols = sorted(set(col for groups in self.rollup_groupings for col in groups))
+        of_classes = """FROM ClassSummaries JOIN Classes
+                            ON Classes.CRN = ClassSummaries.CRN
+                            AND Classes.AcademicYear = ClassSummaries.AcademicYear
+                            AND Classes.Instructor = ClassSummaries.Instructor
+                        WHERE {}""".format(class_filter)
+        groups_of_classes = "SELECT {} {}".format(",".join("ClassSummaries."+col for col in key_cols), of_classes)
+
+        # Rollup key columns of the summaries before and after. Temporary tables don't
+        # commit the transaction like other DDL does.
+        self.cur.execute("DROP TEMPORARY TABLE IF EXISTS SummaryGroups")
+        self.cur.execute("CREATE TEMPORARY TABLE SummaryGroups AS " + groups_of_classes, params)
+        self.cur.execute("DELETE ClassSummaries " + of_classes, params)
+        removed = self.cur.rowcount
+        self.cur.execute("INSERT INTO ClassSummaries " +
+                            self.class_summaries_select(short_strings, class_filter), params)
+        added = self.cur.rowcount
+        self.cur.execute("INSERT INTO SummaryGroups " + groups_of_classes, params)
+
+        for groups in self.rollup_groupings:
+            table = self.rollup_table(groups)
+            touched = "(SELECT DISTINCT {} FROM SummaryGroups) touched".format(",".join(groups))
+            match = lambda source: " AND ".join("{source}.{col} <=> touched.{col}".format(source=source, col=col)
+                                                    for col in groups)
+            self.cur.execute("DELETE {table} FROM {table} JOIN {touched} ON {match}"
+                                .format(table=table, touched=touched, match=match(table)))
+            source_groups = ",".join("ClassSummaries."+col for col in groups)
+            self.cur.execute("""INSERT INTO {table} SELECT {groups},{averages}
+                                FROM ClassSummaries JOIN {touched} ON {match} GROUP BY {groups}"""
+                                .format(table=table, groups=source_groups, touched=touched,
+                                        averages=",".join(self.rollup_averages(short_strings)),
+                                        match=match("ClassSummaries")))
+
+        self.cur.execute("DROP TEMPORARY TABLE SummaryGroups")
+        return added - removed
+
+    # Build a table per grouping set in rollup_groupings, holding the summaries in source
+    # grouped by those columns with the same weighted averages DataTables computes.
+    # Regrouping a rollup by a subset of its columns gives the same results as grouping
+    # ClassSummaries, so the site can read them instead. SummaryRollups lists them.
+    # They're made as shadow tables, published with ClassSummaries.
+    def build_rollups(self, short_strings, source):
+        for groups in self.rollup_groupings:
+            self.cur.execute("CREATE TABLE {table} AS SELECT {groups},{averages} FROM {source} GROUP BY {groups}"
+                                .format(table=self.shadow_table(self.rollup_table(groups)), source=source,
+                                        groups=",".join(groups), averages=",".join(self.rollup_averages(short_strings))))
+
+    # The summaries have '' for questions a class didn't have. In arithmetic that's a
+    # truncation warning, which strict mode makes an error in CREATE TABLE ... SELECT.
+    # Counts stay 0 for groups without the question, like grouping ClassSummaries gives.
+    @staticmethod
+    def rollup_averages(short_strings):
+        return ["""SUM(NULLIF({avg},'')*NULLIF({avg}_N,''))/SUM(NULLIF({avg}_N,'')) AS {avg},
+                   COALESCE(SUM(NULLIF({avg}_N,'')),0) AS {avg}_N""".format(avg=short_string)
+                    for short_string in short_strings]
+
+    # Names the summary tables are built under, and the names the ones they replace are
+    # moved to
+    shadow_suffix = "Shadow"
+    replaced_suffix = "Replaced"
+
+    @classmethod
+    def shadow_table(cls, table):
+        return table + cls.shadow_suffix
+
+    def summary_tables(self):
+        return ["ClassSummaries"] + [self.rollup_table(groups) for groups in self.rollup_groupings]
+
+    def table_exists(self, table):
+        self.cur.execute("SHOW TABLES LIKE %s", table)
+        return self.cur.fetchone() is not None
+
+    # Swap the shadow tables in for ClassSummaries and its rollups with one RENAME, which
+    # MySQL does atomically, so the site never finds them missing or half built. The
+    # tables they replace are kept until drop_build_tables.
+    def publish_summaries(self):
+        renames = []
+        for table in self.summary_tables():
+            if self.table_exists(table):
+                renames.append("{0} TO {0}{1}".format(table, self.replaced_suffix))
+            renames.append("{0}{1} TO {0}".format(table, self.shadow_suffix))
+        self.cur.execute("RENAME TABLE " + ",".join(renames))
+
+    def drop_build_tables(self):
+        tables = [table + suffix for table in self.summary_tables()
+                    for suffix in (self.shadow_suffix, self.replaced_suffix)]
+        self.cur.execute("DROP TABLE IF EXISTS " + ",".join(tables))
+
+    def drop_stale_rollups(self):
+        self.cur.execute("SHOW TABLES LIKE %s", "ClassSummariesBy%")
+        tables = [row.values()[0] for row in self.cur.fetchall()]
+        stale = [table for table in tables if table not in self.summary_tables()]
+        if stale:
+            self.cur.execute("DROP TABLE IF EXISTS " + ",".join(stale))
+
+    @staticmethod
+    def rollup_table(groups):
+        return "ClassSummariesBy" + "".join(groups)
+
+    # indexes, plus one per rollup on its grouping columns
+    def index_spec(self):
+        return self.indexes + [(self.rollup_table(groups), groups) for groups in self.rollup_groupings]
+
+    @staticmethod
+    def index_name(cols):
+        return "By" + "".join(cols)
+
+    # Add the indexes in index_spec that tables don't have yet, with one ALTER per table.
+    # Tables that don't exist are skipped. With a suffix, the tables with that suffix on
+    # their names are indexed instead, like shadow summary tables before they're published.
+    def apply_indexes(self, suffix=""):
+        tables = []
+        for table, cols in self.index_spec():
+            if table not in tables:
+                tables.append(table)
+
+        for table in tables:
+            try:
+                self.cur.execute("SHOW INDEX FROM {}".format(table + suffix))
+            except mdb.ProgrammingError:
+                continue
+            existing = set(row['Key_name'] for row in self.cur.fetchall())
+            missing = ["ADD INDEX {} ({})".format(self.index_name(cols), ",".join(cols))
+                        for index_table, cols in self.index_spec()
+                        if index_table == table and self.index_name(cols) not in existing]
+            if missing:
+                self.cur.execute("ALTER TABLE {} {}".format(table + suffix, ",".join(missing)))
+
+    # Bookkeeping for incremental summary builds
+    def create_summary_tables(self):
+        self.cur.execute("""CREATE TABLE IF NOT EXISTS SummaryState(
+                        Name            VARCHAR(20) PRIMARY KEY,
+                        Value           INT)""")
+        self.cur.execute("""CREATE TABLE IF NOT EXISTS SummaryRollups(
+                        TableName       VARCHAR(64) PRIMARY KEY,
+                        GroupCols       VARCHAR(200))""")
+        # Stored classes that changed since the last summary build
+        self.cur.execute("""CREATE TABLE IF NOT EXISTS SummaryChanges(
+                        ClassID         INT PRIMARY KEY)""")
+
+    # SELECT for ClassSummaries rows. If class_filter is given, only classes whose ClassID
+    # matches it are summarized. It's a WHERE condition on AnswerFields.ClassID.
+    def class_summaries_select(self, short_strings, class_filter=None):
         # Create view for question responses per course
-        
         rows_to_cols = ["""MAX(IF(ShortString='{string}',Avg,'')) AS {string},
                            MAX(IF(ShortString='{string}',Respondents,'')) AS {string}_N""".format(string=short_string) for short_string in short_strings]
-        self.cur.execute("DROP TABLE IF EXISTS ClassSummaries")
-        self.cur.execute("""CREATE TABLE ClassSummaries AS
-                        SELECT                            
+
+        question_avgs = "QuestionAvgs"
+        if class_filter:
+            # Same as the QuestionAvgs view, but filtered before grouping so MySQL only
+            # reads those classes' AnswerFields instead of materializing the whole view
+            question_avgs = """(SELECT 
+                                    ClassID, 
+                                    QuestionID, 
+                                    SUM(Weight*Respondents)/SUM(Respondents) AS Avg,
+                                    SUM(Respondents) AS Respondents
+                                FROM 
+                                    AnswerFields 
+                                WHERE
+                                    {class_filter}
+                                GROUP BY 
+                                    ClassID,
+                                    QuestionID) QuestionAvgs""".format(class_filter=class_filter)
+
+        return """SELECT                            
                             AcademicYear,
                             Terms.Name AS Term,
                             Department,
@@ -163,18 +597,110 @@ class Database(object):
                             CRN,
                             Instructor,
                             ADLN,
-                            {}
+                            {cols},
+                            CONCAT_WS(' ', Instructor, CONCAT(Department,'-',Code), Classes.Name,
+                                      Department, CRN, Terms.Name) AS SearchText
                         FROM
                             Classes
                                 JOIN
                             Terms ON Terms.TermID = Classes.TermID
                                 JOIN
-                            QuestionAvgs ON QuestionAvgs.ClassID = Classes.ClassID
+                            {question_avgs} ON QuestionAvgs.ClassID = Classes.ClassID
                                 JOIN
                             Questions ON Questions.QuestionID = QuestionAvgs.QuestionID
                         GROUP BY
                             Classes.ClassID
-                        """.format(",".join(rows_to_cols)))
+                        """.format(cols=",".join(rows_to_cols), question_avgs=question_avgs)
+
+    # Columns ClassSummaries has, or should have for the given questions
+    def summary_columns(self, short_strings=None):
+        if short_strings is None:
+            try:
+                self.cur.execute("SHOW COLUMNS FROM ClassSummaries")
+            except mdb.ProgrammingError: # Table doesn't exist
+                return None
+            return [row['Field'] for row in self.cur.fetchall()]
+
+        cols = ['AcademicYear','Term','Department','Course','Name','Section','CRN','Instructor','ADLN']
+        for short_string in short_strings:
+            cols += ['{}'.format(short_string), '{}_N'.format(short_string)]
+        return cols + ['SearchText']
+
+    def get_summary_state(self, name):
+        self.cur.execute("SELECT Value FROM SummaryState WHERE Name=%s", name)
+        row = self.cur.fetchone()
+        return row['Value'] if row else None
+
+    def set_summary_state(self, name, value):
+        self.cur.execute("REPLACE INTO SummaryState (Name,Value) VALUES (%s,%s)", (name, value))
+
+# In-process copy of the Terms and Questions IDs, which are tiny and almost never
+# change, so storing classes doesn't need a lookup query per term and question.
+# Misses fall back to the db, and new questions are added as they're stored.
+class IDCache(object):
+    def __init__(self):
+        self.terms = {}
+        self.questions = {}
+        self.hits = 0
+        self.misses = 0
+        # Questions inserted since the last commit, forgotten if it's rolled back
+        self.uncommitted = []
+
+    # Match the db's case insensitive comparisons
+    @staticmethod
+    def key(*parts):
+        return tuple((part.decode('utf-8') if isinstance(part, str) else unicode(part)).lower()
+                        for part in parts)
+
+    def warm(self, cur):
+        self.terms.clear()
+        self.questions.clear()
+
+        cur.execute("SELECT TermID,Name FROM Terms")
+        for row in cur.fetchall():
+            self.terms[self.key(row['Name'])] = row['TermID']
+
+        cur.execute("SELECT QuestionID,Num,FullString FROM Questions")
+        for row in cur.fetchall():
+            self.questions[self.key(row['Num'], row['FullString'])] = row['QuestionID']
+
+    def term_id(self, cur, name):
+        key = self.key(name)
+        if key in self.terms:
+            self.hits += 1
+        else:
+            self.misses += 1
+            cur.execute("SELECT TermID FROM Terms WHERE Name=%s",name)
+            self.terms[key] = cur.fetchone()['TermID']
+        return self.terms[key]
+
+    # ID of a QuestionInstance, storing it if it's a new question
+    def question_id(self, cur, question):
+        key = self.key(question.Num, question.FullString)
+        if key in self.questions:
+            self.hits += 1
+        else:
+            self.misses += 1
+            q_id = question.get_ID(cur)
+            if not q_id:
+                q_id = super(QuestionInstance, question).store(cur)
+                self.uncommitted.append(key)
+            self.questions[key] = q_id
+        return self.questions[key]
+
+    def commit(self):
+        self.uncommitted = []
+
+    def rollback(self):
+        for key in self.uncommitted:
+            self.questions.pop(key, None)
+        self.uncommitted = []
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'terms': len(self.terms),
+                'questions': len(self.questions)}
 
 class Storable(object):
     field_blacklist = []
@@ -184,10 +710,19 @@ class Storable(object):
     def __init__(self, **kwargs):
         self.__dict__ = kwargs
 
+    # (column, value) pairs that get stored
+    def fields(self):
+        return sorted((key,val) for key,val in self.__dict__.items()
+                        if key not in self.field_blacklist)
+
+    # Attributes as plain values, except those in exclude. BeautifulSoup strings
+    # keep their whole tree alive, so they're converted to unicode.
+    def plain_fields(self, exclude=()):
+        return {key: unicode(val) if isinstance(val, unicode) else val
+                    for key,val in self.__dict__.items() if key not in exclude}
+
     def execute_template(self, cur, query_template):
-        db_pairs = [(key,val) for key,val in self.__dict__.items() 
-                        if key not in self.field_blacklist]
-        db_cols, db_vals = zip(*db_pairs)
+        db_cols, db_vals = zip(*self.fields())
         
         where_clause = " AND ".join(col+"=%s" for col in db_cols)
         query = query_template.format(table = self.table,
@@ -199,7 +734,8 @@ class Storable(object):
         cur.execute(query,db_vals)
         return cur.fetchone()
 
-    def store(self, cur):
+    # ids is an IDCache for the objects that look up other tables' IDs
+    def store(self, cur, ids=None):
         self.execute_template(cur,"INSERT INTO {table} ({cols}) VALUES ({vals})")
 
         cur.execute("SELECT LAST_INSERT_ID()")
@@ -224,11 +760,45 @@ class Evaluation(Storable):
         self.__dict__ = kwargs
         self.questions = []        
 
-    def store(self, cur):
+    # Key of the uc_Class constraint, from a Classes row or an Evaluation's fields
+    @staticmethod
+    def unique_key(fields):
+        instructor = fields['Instructor']
+        if isinstance(instructor, str):
+            instructor = instructor.decode('utf-8')
+        # Compare instructors the way MySQL's default collation does
+        return (int(fields['CRN']), int(fields['AcademicYear']), instructor.lower().rstrip())
+
+    # Compact, picklable form for sending parse results between processes
+    def pack(self):
+        return (self.plain_fields(['questions']),
+                [(q.plain_fields(['answers']), [a.plain_fields() for a in q.answers])
+                    for q in self.questions])
+
+    @staticmethod
+    def unpack(packed):
+        fields, questions = packed
+        ev = Evaluation(**fields)
+        for q_fields, answers in questions:
+            question = QuestionInstance(**q_fields)
+            question.answers = [AnswerField(**a_fields) for a_fields in answers]
+            ev.questions.append(question)
+        return ev
+
+    # Whether storing this would break the uc_AnswerField constraint by itself
+    def has_duplicate_answers(self):
+        keys = [(q.Num, q.FullString, a.__dict__.get('AnswerText'), a.__dict__.get('Weight'))
+                    for q in self.questions for a in q.answers]
+        # NULLs never match in unique constraints
+        keys = [key for key in keys if None not in key]
+        return len(keys) != len(set(keys))
+
+    def store(self, cur, ids=None):
+        ids = ids or IDCache()
+
         #replace TermName with TermID
         try:
-            cur.execute("SELECT TermID FROM Terms WHERE Name=%s",self.TermName)
-            self.TermID = cur.fetchone()['TermID']
+            self.TermID = ids.term_id(cur, self.TermName)
         except AttributeError: 
             #We don't have a TermName, so don't bother with term
             pass
@@ -237,7 +807,7 @@ class Evaluation(Storable):
 
         for question in self.questions:
             question.ClassID = class_id
-            question.store(cur)
+            question.store(cur, ids)
 
 
 class QuestionInstance(Storable):
@@ -249,12 +819,8 @@ class QuestionInstance(Storable):
         self.__dict__ = kwargs
         self.answers = []        
 
-    def store(self, cur):
-        q_id = self.get_ID(cur)
-
-        # If the question wasn't found, store it
-        if not q_id:
-            q_id = super(QuestionInstance, self).store(cur)
+    def store(self, cur, ids=None):
+        q_id = (ids or IDCache()).question_id(cur, self)
 
         for answer in self.answers:
             answer.QuestionID = q_id
@@ -264,10 +830,12 @@ class QuestionInstance(Storable):
 class AnswerField(Storable):
     table = "AnswerFields"
     id_col = "AnswerFieldID"
+    columns = ["AnswerText", "Weight", "Respondents", "QuestionID", "ClassID"]
 
 class FailedScrape(Storable):
     table = "FailedScrapes"
     id_col = "FailedScrapeID"
+    reason_length = 200
 
 
 
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+# Synthetic evaluation pages for benchmarking the ingest path.
+# Pages look like bannerweb's: a header row with the course, section and CRN, the
+# instructor, and a table of questions in both of the layouts parse_eval handles:
+# rated questions with all five responses on one 8 cell row, and multiple choice
+# questions with one answer per row.
+
+from __future__ import print_function
+import random
+import csv
+import os
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Answers for the questions that aren't rated 1-5
+text_answers = {
+    '24': ['A', 'B', 'C', 'NR/D/F'],
+    '25': ['Required in major', 'Elective in major', 'Required outside major', 'Free elective'],
+    '26': ['0', '1-5', '6-10', '11-15', '16-20', '21+'],
+    '26A': ['0', '1-2', '3-4', '5+'],
+    '26B': ['0', '1-5', '6-10', '11-15', '16-20', '21+'],
+}
+
+departments = ['CS', 'ECE', 'ME', 'MA', 'PH', 'BB', 'CH', 'HI', 'EN', 'MU', 'RBE', 'BME']
+terms = ['A', 'B', 'C', 'D']
+words = ['Introduction', 'Advanced', 'Topics', 'Design', 'Analysis', 'Systems', 'Theory',
+         'Methods', 'Applied', 'Engineering', 'Foundations', 'Computation', 'Laboratory']
+
+def load_questions(path=os.path.join(data_dir, 'questions.csv')):
+    with open(path) as f:
+        return [(row['Num'], row['FullString']) for row in csv.DictReader(f)]
+
+questions = load_questions()
+
+def header(ev):
+    return ('<table class="datadisplaytable" summary="Course">'
+            '<tr><th class="ddlabel" scope="row">Academic Year {prev}-{year}</th></tr>'
+            '<tr><td class="dddefault"><b>{dept}-{code} {name}</b><br>'
+            'Section {section} &nbsp; CRN {crn} &nbsp; {season} {cal_year}</td></tr>'
+            '<tr><TH CLASS="ddheader" scope="col">Prof. {instructor}</TH></tr>'
+            '</table>').format(prev=ev['year']-1, **ev)
+
+def rated_question(num, text, counts):
+    cells = "".join('<td class="dddefault"><p><img src="/wtlgifs/bar.gif" width="{width}">{count}</p></td>'
+                        .format(width=count*3, count=count) for count in counts)
+    total = sum(counts)
+    mean = sum((i+1)*count for i, count in enumerate(counts)) / float(total or 1)
+    return ('<tr><th class="ddtitle" colspan="8">Question</th></tr>'
+            '<tr><td class="dddefault">{num}. {text}</td>{cells}'
+            '<td class="dddefault">{total}</td><td class="dddefault">{mean:.2f}</td></tr>'
+                .format(num=num, text=text, cells=cells, total=total, mean=mean))
+
+def text_question(num, text, answers):
+    rows = "".join('<tr><td class="dddefault">{}</td><td class="dddefault">{}</td></tr>'
+                        .format(answer, count) for answer, count in answers)
+    return ('<tr><th class="ddtitle" colspan="2">Question</th></tr>'
+            '<tr><td class="dddefault">{num}. {text}</td></tr>{rows}'
+                .format(num=num, text=text, rows=rows))
+
+# Class info for a page. Seeded by its CRN, year and instructor, so the same class
+# always gets the same page.
+def class_info(crn, year, pidm):
+    rand = random.Random('{}-{}-{}'.format(crn, year, pidm))
+    term = rand.choice(terms)
+    return {
+        'crn': crn,
+        'year': int(year),
+        'dept': rand.choice(departments),
+        'code': '{}{:03d}'.format(rand.randint(1, 4), rand.randint(0, 999)),
+        'name': " ".join(rand.sample(words, rand.randint(2, 4)))[:40].rstrip(),
+        'section': '{}{:02d}'.format(term, rand.randint(1, 12)),
+        'season': 'Fall' if term in 'AB' else 'Spring',
+        'cal_year': int(year)-1 if term in 'AB' else int(year),
+        'instructor': 'Instructor {}'.format(pidm),
+        'rand': rand,
+    }
+
+# Full eval page html for a class
+def eval_page(crn, year, pidm):
+    ev = class_info(crn, year, pidm)
+    rand = ev['rand']
+    respondents = rand.randint(3, 120)
+
+    rows = []
+    for num, text in questions:
+        if num in text_answers:
+            answers = [(answer, rand.randint(0, respondents)) for answer in text_answers[num]]
+            rows.append(text_question(num, text, answers))
+        else:
+            rows.append(rated_question(num, text, [rand.randint(0, respondents//3) for _ in range(5)]))
+    rows.append('<tr><th class="ddtitle">End</th></tr>')
+
+    return ('<html><head><title>Course Evaluation Results</title></head><body>'
+            '<div class="pagebodydiv">{header}'
+            '<table class="datadisplaytable" summary="Results">{rows}</table>'
+            '</div></body></html>').format(header=header(ev), rows="".join(rows))
+
+if __name__ == "__main__":
+    print(eval_page(12345, 2016, 1))
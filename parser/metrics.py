@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+from contextlib import contextmanager
+import threading
+import bisect
+import json
+import time
+import os
+
+# Histogram of durations in seconds, with exponential buckets from 0.5ms to about a
+# minute. Keeps counts per bucket rather than every sample, so it stays small on
+# runs of any length, and percentiles are estimated within a bucket.
+class Histogram(object):
+    bounds = [0.0005 * 2**i for i in range(18)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1) # Last is everything over the top bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Estimate the pct percentile by interpolating within its bucket
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        rank = self.count * pct / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[idx-1] if idx else 0.0
+                upper = self.bounds[idx] if idx < len(self.bounds) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': [[bound, count] for bound, count in zip(self.bounds, self.counts)]
+                           + [['+Inf', self.counts[-1]]]}
+
+# Counters and histograms for an ingest run, safe to update from any thread.
+# Names can have a label, like failures by exception type: count('failures', 'Timeout').
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def count(self, name, label=None, amount=1):
+        with self.lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    # with metrics.timed('parse'): ...
+    @contextmanager
+    def timed(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def to_dict(self):
+        with self.lock:
+            counters = {}
+            for (name, label), value in sorted(self.counters.items()):
+                if label is None:
+                    counters[name] = value
+                else:
+                    counters.setdefault(name, {})[label] = value
+            return {'elapsed': time.time() - self.started, 'counters': counters,
+                    'histograms': {name: hist.to_dict() for name, hist in self.histograms.items()}}
+
+    # Prometheus text exposition format, names prefixed with evals_
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for (name, label), value in sorted(self.counters.items()):
+                labels = '{{type="{}"}}'.format(label) if label is not None else ''
+                lines.append('evals_{}_total{} {}'.format(name, labels, value))
+            for name, hist in sorted(self.histograms.items()):
+                metric = 'evals_{}_seconds'.format(name)
+                lines.append('# TYPE {} histogram'.format(metric))
+                cumulative = 0
+                for bound, count in zip(hist.bounds + ['+Inf'], hist.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+                lines.append('{}_sum {}'.format(metric, hist.sum))
+                lines.append('{}_count {}'.format(metric, hist.count))
+        return '\n'.join(lines) + '\n'
+
+    # Write to path, as Prometheus text if it ends in .prom, otherwise JSON.
+    # Written to a temp file and renamed, so readers never see half a file.
+    def write(self, path):
+        if path.endswith('.prom'):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.rename(tmp_path, path)
+
+    # Table of stage latencies and counters, for the end of a run
+    def summary(self):
+        data = self.to_dict()
+        lines = ["{:10} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+                    'stage', 'count', 'total s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        for name in sorted(data['histograms']):
+            hist = data['histograms'][name]
+            lines.append("{:10} {:8d} {:9.1f} {:9.2f} {:9.2f} {:9.2f} {:9.2f}".format(
+                    name, hist['count'], hist['sum'],
+                    *[hist[key]*1000 for key in ['p50', 'p90', 'p99', 'max']]))
+        for name, value in sorted(data['counters'].items()):
+            if isinstance(value, dict):
+                for label, count in sorted(value.items()):
+                    lines.append("{:28} {}".format('{} ({})'.format(name, label), count))
+            else:
+                lines.append("{:28} {}".format(name, value))
+        return '\n'.join(lines)
+
+# Writes metrics to a file every interval seconds until stopped, and once more at the end
+class MetricsWriter(object):
+    def __init__(self, metrics, path, interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.write(self.path)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.metrics.write(self.path)
+
+# Shared by everything in the process
+metrics = Metrics()
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+# Local stand-in for bannerweb, for exercising Downloader without touching the real site.
+# Serves the login, class listing and evaluation pages, and can inject latency, server
+# errors, hanging requests and expiring sessions.
+#
+# mock_bannerweb.py [-p PORT] [-n CLASSES] [-l LATENCY] [-e ERROR_RATE] [-t TIMEOUT_RATE] [-x EXPIRE_EVERY]
+#
+# Then point the parser at it with parser.use_server(server.url).
+
+from __future__ import print_function
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from evalgen import eval_page
+import urlparse
+import threading
+import socket
+import random
+import getopt
+import time
+import uuid
+import sys
+
+paths = {
+    'login': '/pls/prod/twbkwbis.P_WWWLogin',
+    'validate': '/pls/prod/twbkwbis.P_ValLogin',
+    'sel_section': '/pls/prod/hwwkscevrp.P_Select_CrseSect',
+    'eval': '/pls/prod/hwwkscevrp.P_ShowEval'
+}
+
+def listing_page(classes, year, adln_char):
+    rows = ['<tr><td class="dddefault"><a href="{path}?IN_TYPE=C&IN_CRN={crn}&IN_ACYR={year}'
+            '&IN_ADLN_OIX={adln}&IN_PIDM={pidm}">CS-{crn}</a></td></tr>'
+                .format(path=paths['eval'], crn=crn, year=year, adln=adln_char, pidm=pidm)
+            for crn, pidm in classes]
+    return ('<html><body><table class="datadisplaytable">{}</table></body></html>'
+                .format("".join(rows)))
+
+class MockBannerweb(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # classes: number of classes listed per year and ADLN
+    # latency: seconds added to every eval page
+    # error_rate: fraction of eval pages that return 503
+    # timeout_rate: fraction of eval pages that hang for timeout_delay seconds
+    # expire_every: sessions expire after this many eval pages, 0 for never
+    # pages: function (crn, year, pidm) -> eval page html
+    def __init__(self, port=0, classes=100, latency=0.0, error_rate=0.0, timeout_rate=0.0,
+                 timeout_delay=120.0, expire_every=0, pages=eval_page, seed=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+        self.classes = classes
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.expire_every = expire_every
+        self.pages = pages
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.stats = {'logins': 0, 'listings': 0, 'evals': 0, 'errors': 0, 'timeouts': 0, 'expired': 0}
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # Clients that timed out have hung up by the time a hanging page is sent, which
+    # is expected, so only report other errors
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    # (crn, pidm) of listed classes. Every tenth CRN has a second instructor, like real listings.
+    def class_list(self, year, adln):
+        base = 10000 + int(year) % 100 * 1000 + (500 if adln else 0)
+        classes = []
+        for idx in range(self.classes):
+            crn = base + idx - idx//10
+            classes.append((crn, idx))
+        return classes
+
+    def new_session(self):
+        sessid = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[sessid] = 0
+            self.stats['logins'] += 1
+        return sessid
+
+    # Whether sessid is logged in, counting another use of it
+    def use_session(self, sessid):
+        with self.lock:
+            if sessid not in self.sessions:
+                return False
+            self.sessions[sessid] += 1
+            if self.expire_every and self.sessions[sessid] > self.expire_every:
+                del self.sessions[sessid]
+                self.stats['expired'] += 1
+                return False
+            return True
+
+class MockHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_page(self, html, status=200, headers={}):
+        body = html.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sessid(self):
+        for cookie in self.headers.getheaders('Cookie'):
+            for part in cookie.split(';'):
+                name, _, value = part.strip().partition('=')
+                if name == 'SESSID':
+                    return value
+        return None
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+        server = self.server
+
+        if path == paths['eval']:
+            if not server.use_session(self.sessid()):
+                self.send_page('', 302, {'Location': paths['login']})
+                return
+
+            server.count('evals')
+            time.sleep(server.latency)
+            roll = server.random.random()
+            if roll < server.error_rate:
+                server.count('errors')
+                self.send_page('<html>Service Unavailable</html>', 503)
+            elif roll < server.error_rate + server.timeout_rate:
+                server.count('timeouts')
+                time.sleep(server.timeout_delay)
+                self.send_page('<html>Too late</html>', 504)
+            else:
+                self.send_page(server.pages(params['IN_CRN'], params['IN_ACYR'], params['IN_PIDM']))
+        else: # Home and login pages
+            self.send_page('<html><body>Mock bannerweb</body></html>')
+
+    def do_POST(self):
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+        server = self.server
+
+        if path == paths['validate']:
+            self.send_page('<html>Welcome</html>', 200,
+                           {'Set-Cookie': 'SESSID={}; Path=/'.format(server.new_session())})
+        elif path == paths['sel_section']:
+            if self.sessid() not in server.sessions:
+                self.send_page('', 302, {'Location': paths['login']})
+                return
+            server.count('listings')
+            year, adln_char = params['IN_ACYR'], params['IN_ADLN_OIX']
+            self.send_page(listing_page(server.class_list(year, adln_char=='O'), year, adln_char))
+        else:
+            self.send_page('', 404)
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "p:n:l:e:t:x:")
+    except getopt.GetoptError:
+        print("mock_bannerweb.py [-p PORT] [-n CLASSES] [-l LATENCY] [-e ERROR_RATE] "
+              "[-t TIMEOUT_RATE] [-x EXPIRE_EVERY]")
+        return
+
+    settings = {}
+    names = {'-p': ('port', int), '-n': ('classes', int), '-l': ('latency', float),
+             '-e': ('error_rate', float), '-t': ('timeout_rate', float), '-x': ('expire_every', int)}
+    for opt, arg in opts:
+        name, type_ = names[opt]
+        settings[name] = type_(arg)
+
+    server = MockBannerweb(**settings)
+    print("Serving mock bannerweb at {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
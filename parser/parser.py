@@ -2,14 +2,26 @@
 
 from __future__ import print_function
 from eval_db import Database, Evaluation, QuestionInstance, AnswerField, FailedScrape
+from archive import EvalArchive
+from ratelimit import AdaptiveRateLimiter, backoff_delay
+from metrics import metrics, MetricsWriter
 from bs4 import BeautifulSoup
+from lxml import etree
+import lxml.html
 from MySQLdb import DatabaseError
 import re
 import sys
 import requests
 import getpass
 import traceback
+import time
 import getopt
+import threading
+import Queue
+import collections
+import hashlib
+import json
+import multiprocessing
 
 # Python 3 improvements: flush prints insted of using -u
 # super lookes nicer
@@ -37,6 +49,15 @@ pages = {
     'sel_section': 'https://bannerweb.wpi.edu/pls/prod/hwwkscevrp.P_Select_CrseSect'
 }
 
+pages_base = pages['home']
+
+# Point pages at another server, like mock_bannerweb
+def use_server(base_url):
+    global pages_base
+    for name, url in pages.items():
+        pages[name] = base_url + url[len(pages_base):]
+    pages_base = base_url
+
 # Allow reraising other exceptions as ParseErrors while preserving info
 class ParseError(Exception):
     def __init__(self, message="", cause=None):
@@ -52,12 +73,34 @@ class ParseError(Exception):
 class LoginError(Exception):
 	pass
 
+# Responses worth retrying, the server is busy or struggling
+transient_statuses = (429, 500, 502, 503, 504)
+transient_errors = (requests.exceptions.Timeout,
+					requests.exceptions.ConnectionError,
+					requests.exceptions.HTTPError)
+
 class Downloader(object):
-	def __init__(self, user, passwd):
+	# If archive is given, downloaded evals are saved to it, and evals already in it
+	# are read from disk instead of downloaded unless refresh is set.
+	# Requests go through limiter (an AdaptiveRateLimiter), and transient failures are
+	# retried up to retries times. Eval pages taking longer than timeout seconds count
+	# as failures.
+	def __init__(self, user, passwd, archive=None, refresh=False, limiter=None, retries=4,
+				 timeout=60):
 		self.user = user
 		self.passwd = passwd
+		self.archive = archive
+		self.refresh = refresh
+		self.limiter = limiter or AdaptiveRateLimiter()
+		self.retries = retries
+		self.timeout = timeout
 		self.sess = requests.Session()
 
+	# New downloader with the same settings and rate limit but its own session
+	def clone(self):
+		return self.__class__(self.user, self.passwd, self.archive, self.refresh,
+							  self.limiter, self.retries, self.timeout)
+
 	def login(self):
 		print("\nLogging in... ", end='')
 		self.sess.get(pages['home'])
@@ -75,43 +118,115 @@ class Downloader(object):
 		else:
 			print("Success")
 
-	def download_eval(self, url):
-		if 'SESSID' not in self.sess.cookies:
-			self.login()
+	# Bannerweb sends us back to the login page when SESSID expires
+	def session_expired(self, response):
+		return ('SESSID' not in self.sess.cookies
+				or any(pages['login'] in r.url for r in response.history + [response]))
+
+	# Make a rate limited request, retrying transient failures with jittered exponential
+	# backoff and logging in again if the session expires. Raises the last error if
+	# every try fails.
+	def request(self, method, url, **kwargs):
+		for attempt in range(self.retries + 1):
+			if 'SESSID' not in self.sess.cookies:
+				self.login()
+
+			self.limiter.acquire()
+			start = time.time()
+			try:
+				response = self.sess.request(method, url, **kwargs)
+				if self.session_expired(response):
+					# Not the server's fault, so retry straight away after logging in
+					self.sess.cookies.clear()
+					continue
+				if response.status_code in transient_statuses:
+					response.raise_for_status()
+			except transient_errors:
+				self.limiter.record(time.time() - start, error=True)
+				if attempt == self.retries:
+					raise
+				metrics.count('retries')
+				time.sleep(backoff_delay(attempt))
+			else:
+				self.limiter.record(time.time() - start)
+				return response
+
+		raise LoginError('Session expired on every try')
 
-		response = self.sess.get(pages['home'] + url, timeout=60)
+	def download_eval(self, url):
+		if self.archive:
+			crn, year, adln = parse_class_url(url)
+			if not self.refresh:
+				text = self.archive.get(year, adln, crn, url)
+				if text is not None:
+					metrics.count('archive_hits')
+					return text
+
+		with metrics.timed('download'):
+			response = self.request('GET', pages['home'] + url, timeout=self.timeout)
+		metrics.count('download_bytes', amount=len(response.content))
+
+		if self.archive:
+			self.archive.put(year, adln, crn, url, response.text)
 		return response.text
 
 	# Return list of urls for year, adln, and crn filters. crns is list of strings.
 	def get_urls_by_year(self, year, adln=False, crns=[]):
-		if 'SESSID' not in self.sess.cookies:
-			self.login()
+		# Return a list so we have its length available
+		urls = list(self.iter_urls_by_year(year, adln, crns))
+		print("Done")
+		return urls
 
+	# Yield urls for year, adln, and crn filters as the class listing downloads.
+	# The listing is several MB, so it's parsed incrementally and each row is thrown
+	# away once its links are read, keeping memory flat however long it is.
+	def iter_urls_by_year(self, year, adln=False, crns=[]):
 		print("Downloading list of {} classes for {}-{}... ".format(
 				"ADLN" if adln else "non-ADLN", year-1,year), end='')
 
-		response = self.sess.post(pages['sel_section'],
+		response = self.request('POST', pages['sel_section'],
 									params = {
 										'IN_SUBCRSE': '',
 										'IN_PIDM': '',
 										'IN_ACYR': year,
 										'IN_ADLN_OIX': "O" if adln else "X"
-									}, timeout=600)
-		print("Done")
-
-		soup = BeautifulSoup(response.text, 'lxml')
-		if crns:
-			# Filter urls by provided list of crns
-			regex_str = r".*IN_CRN=(?:" + "|".join(crns) + ")" 
-		else:
-			# If no list provided, get all crns
-			regex_str = r".*IN_TYPE=C"
+									}, timeout=600, stream=True)
 
-		class_links = (soup.find('table', class_='datadisplaytable')
-				   	 .find_all('a', href=re.compile(regex_str)))
-
-		# Return a list so we have its length available
-		return [link['href'] for link in class_links]
+		crns = set(str(crn) for crn in crns)
+		parser = etree.HTMLPullParser(events=('end',), tag=('a','tr'), encoding=response.encoding)
+		try:
+			for chunk in response.iter_content(chunk_size=64*1024):
+				parser.feed(chunk)
+				for url in self.listing_urls(parser, crns):
+					yield url
+			parser.close()
+			for url in self.listing_urls(parser, crns):
+				yield url
+		finally:
+			response.close()
+
+	# Class urls from the links parsed so far, filtered by crns if given
+	@staticmethod
+	def listing_urls(parser, crns):
+		for _, el in parser.read_events():
+			if el.tag == 'a':
+				href = el.get('href', '')
+				in_listing = any('datadisplaytable' in (table.get('class') or '').split()
+									for table in el.iterancestors('table'))
+				if crns:
+					# Filter urls by provided list of crns
+					crn = re.compile(r"IN_CRN=(\d+)").search(href)
+					wanted = crn and crn.group(1) in crns
+				else:
+					# If no list provided, get all crns
+					wanted = "IN_TYPE=C" in href
+				if in_listing and wanted:
+					yield href
+			else:
+				# Done with this row, free it and any rows before it
+				el.clear()
+				while el.getprevious() is not None:
+					del el.getparent()[0]
 
 def parse_eval(text):
     # Replace any &nbsp; in the html with spaces
@@ -192,108 +307,571 @@ def parse_eval(text):
 
     return ev
 
+
+# Class test matching BeautifulSoup's class_="dddefault", which matches any of an element's classes
+def _has_class(cls):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(cls)
+
+dddefault_cells = etree.XPath(".//td[{}]".format(_has_class("dddefault")))
+question_cells = etree.XPath("//td[{}]".format(_has_class("dddefault")))
+title_headers = etree.XPath(".//th[{}]".format(_has_class("ddtitle")))
+crn_strings = etree.XPath("//text()[contains(., 'CRN ')]")
+
+# Equivalent of BeautifulSoup's tag.string: the text of an element whose only child is
+# a string, or (recursively) the string of its only child element. None otherwise.
+def _string(el):
+    if len(el) == 0:
+        return el.text
+    if len(el) == 1 and not el.text and not el[0].tail:
+        return _string(el[0])
+    return None
+
+# Equivalent of BeautifulSoup's tag.contents: text and element children in order
+def _contents(el):
+    contents = [el.text] if el.text else []
+    for child in el:
+        contents.append(child)
+        if child.tail:
+            contents.append(child.tail)
+    return contents
+
+# Fast path version of parse_eval. Uses lxml directly and only looks at the header row
+# and question cells, instead of searching a BeautifulSoup tree. Returns the same results.
+def parse_eval_lxml(text):
+    text = text.replace(u'\xa0',' ')
+
+    root = lxml.html.document_fromstring(text)
+
+    # Extract all class info from the header
+    ev = Evaluation()
+    try:
+        ev.AcademicYear = re.compile(r"Academic Year \d{4}-(\d{4})").search(text).group(1)
+
+        crn_re = re.compile(r"CRN (\d+)")
+        crn_str = next(string for string in crn_strings(root) if crn_re.search(string))
+        # Tail text belongs to the element's parent, like BeautifulSoup's .parent
+        crn_parent = crn_str.getparent()
+        if crn_str.is_tail:
+            crn_parent = crn_parent.getparent()
+        header_row = lxml.html.tostring(crn_parent.getparent(), encoding='unicode', with_tail=False)
+
+        ev.CRN = crn_re.search(crn_str).group(1)
+
+        # Decompose parts of full course name
+        course = re.compile(r"<b>([A-Z]{2,4})-([\dX]{3,4}) (.+?)</b>").search(header_row)
+        ev.Department = course.group(1)
+        ev.Code = course.group(2)
+        ev.Name = course.group(3)
+
+        # Identify term from section or season
+        ev.Section = section = re.compile(r"Section (\w+)").search(header_row).group(1)
+        if section[0] in 'ABCD':
+            ev.TermName = section[0]
+        else:
+            ev.TermName = re.compile(r"(Spring|Fall|Summer) \d{4}").search(header_row).group(1)
+
+        ev.Instructor = re.compile(r"<TH.*?>Prof\. (.*?)</TH>").search(text).group(1)
+
+    except (AttributeError,IndexError,StopIteration) as e:
+        raise ParseError("Error parsing course info",e), None, sys.exc_info()[2]
+
+    # Extract all questions, possible answers, and answer values
+    try:
+        question_re = re.compile(r"(\d{1,2}[A-Z]?)\. (.+)")
+        for q_tag in question_cells(root):
+            q_string = _string(q_tag)
+            if q_string is None or not question_re.search(q_string):
+                continue
+
+            question_num, question_str = question_re.search(q_string).groups()
+            question = QuestionInstance(Num=question_num, FullString=question_str)
+
+            row = q_tag.getparent()
+            row_cells = dddefault_cells(row)
+            if len(row_cells)==8: # All data on one row, 1-5 response
+                for i in range(5):
+                    respondents = _contents(row_cells[i+1].find(".//p"))[1]
+                    if not isinstance(respondents, basestring):
+                        respondents = lxml.html.tostring(respondents, encoding='unicode', with_tail=False)
+                    question.answers.append(AnswerField(Weight=i+1, Respondents=respondents))
+            elif len(row_cells)==1:
+                # Answers are one per row on following rows, up to the next question header
+                for answer_row in row.itersiblings("tr"):
+                    if title_headers(answer_row):
+                        break
+                    cells = dddefault_cells(answer_row)
+
+                    answer = AnswerField(AnswerText=_string(cells[0]),
+                                         Respondents=_string(cells[1]))
+
+                    question.answers.append(answer)
+
+            else:
+                raise ParseError("Unexpected number of cells in row")
+
+            ev.questions.append(question)
+
+    except (AttributeError,IndexError) as e:
+        raise ParseError("Error parsing evaluation results",e), None, sys.exc_info()[2]
+
+    return ev
+
+# Available parse_eval engines, selected with parser.py -p
+parsers = {'bs4': parse_eval, 'lxml': parse_eval_lxml}
+
+# Errors that are recorded as FailedScrapes instead of stopping the run
+scrape_errors = (ParseError, DatabaseError, requests.exceptions.RequestException)
+
+# Marks the end of the work on a pipeline queue
+_DONE = object()
+
+# Marks a class whose page hasn't changed since it was stored
+_UNCHANGED = object()
+
+# Hash identifying an eval page's contents, stored as the class's SourceHash
+def source_hash(text):
+	return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# Extract (crn, year, adln) from a class url
+def parse_class_url(url):
+	crn = re.compile(r'IN_CRN=(\d*)').search(url).group(1)
+	year = re.compile(r'IN_ACYR=(\d*)').search(url).group(1)
+	adln_char = re.compile(r'IN_ADLN_OIX=(\w)').search(url).group(1)
+	if adln_char not in 'OX':
+		raise ParseError("ADLN in URL must be O or X")
+	return crn, year, adln_char=='O'
+
+# Report a failed download, parse or store and record it so it can be rerun with -f
+def record_failure(db, job, error, tb_str=''):
+	url, crn, year, adln = job
+	if isinstance(error, ParseError):
+		print("\nError parsing CRN {}:".format(crn))
+		print(tb_str)
+	elif isinstance(error, DatabaseError):
+		print("\nError storing CRN {}: {}\n".format(crn, repr(error)))
+	elif isinstance(error, requests.exceptions.Timeout):
+		print("\nTimed out while loading CRN {}".format(crn))
+	else:
+		print("\nError loading CRN {}: {}".format(crn, repr(error)))
+
+	metrics.count('failures', type(error).__name__)
+	reason = "{}: {}".format(type(error).__name__, error)[:FailedScrape.reason_length]
+	db.store(FailedScrape(CRN=crn, AcademicYear=year, ADLN=adln, Reason=reason))
+
 # Only call options: 
 # process_evals(db, dl, year, adln)
 # process_evals(db, dl, year, adln, crns)
 # process_evals(db, dl, urls)
-def process_evals(db, dl, year=None, adln=False, crns=[], urls=[]):
-	use_urls = bool(urls)
-	if not urls:
+# workers > 1 downloads that many classes at once, and processes > 1 parses in that
+# many processes, see run_pipeline.
+# Classes whose page is the same as when they were stored are skipped, and classes
+# whose page has changed are replaced.
+def process_evals(db, dl, year=None, adln=False, crns=[], urls=[], workers=1, parse=parse_eval,
+				  processes=1):
+	pipelined = workers > 1 or processes > 1
+
+	if urls: #extract year, adln from url
+		jobs = [(url,) + parse_class_url(url) for url in urls]
+	elif pipelined:
+		# Start downloading classes while the listing is still coming in. The listing
+		# gets its own session since the pipeline's are busy downloading.
+		jobs = ((url, parse_class_url(url)[0], year, adln)
+					for url in dl.clone().iter_urls_by_year(year, adln, crns))
+	else:
 		urls = dl.get_urls_by_year(year, adln, crns)
+		jobs = [(url, parse_class_url(url)[0], year, adln) for url in urls]
 
-	for idx, url in enumerate(urls):
-		crn = re.compile('IN_CRN=(\d*)').search(url).group(1)
+	known = db.source_hashes(set(job[2] for job in jobs) if urls else [year])
 
-		if use_urls: #extract year, adln from url if needed
-			year = re.compile('IN_ACYR=(\d*)').search(url).group(1)
-			adln_char = re.compile('IN_ADLN_OIX=(\d*)').search(url).group(1)
-			if adln_char not in 'OX':
-				raise ParseError("ADLN in URL must be O or X")
-			adln = adln_char=='O'
+	if pipelined:
+		# Start the pool before any threads, so it forks a clean process
+		pool = multiprocessing.Pool(processes) if processes > 1 else None
+		try:
+			run_pipeline(db, dl, jobs, workers, parse=parse, pool=pool, known=known)
+		finally:
+			if pool:
+				pool.terminate()
+		print("\nDone")
+		return
 
-		print("\rDownloading and parsing class {}/{} (CRN {})".format(idx+1,len(urls),crn), end='')
+	unchanged = 0
+	for idx, job in enumerate(jobs):
+		url, crn, year, adln = job
+		print("\rDownloading and parsing class {}/{} (CRN {})".format(idx+1,len(jobs),crn), end='')
 
 		try:
 			eval_text = dl.download_eval(url)
-			ev = parse_eval(eval_text)
+			if source_hash(eval_text) in known:
+				unchanged += 1
+				metrics.count('unchanged')
+				continue
+			with metrics.timed('parse'):
+				ev = parse(eval_text)
 			ev.ADLN = adln
-			db.store(ev)
-		except ParseError as e:
-			#_, _, tb = sys.exc_info()
-			print("\nError parsing CRN {}:".format(crn))
-			traceback.print_exc()
-			print()
-			db.store(FailedScrape(CRN=crn, AcademicYear=year, ADLN=adln))
-			#print(crn, year, adln, file=failed_crns)				
-		except DatabaseError as e:
-			print("\nError storing CRN {}: {}\n".format(crn, repr(e)))
-			db.store(FailedScrape(CRN=crn, AcademicYear=year, ADLN=adln))
-			#print(crn, file=failed_crns)
-		except requests.exceptions.Timeout:
-			print("\nTimed out while loading CRN {}".format(crn))
-			db.store(FailedScrape(CRN=crn, AcademicYear=year, ADLN=adln)) #!!Add reason to failed table
+			ev.SourceHash = source_hash(eval_text)
+			store_batch(db, [(job, ev)])
+		except scrape_errors as e:
+			record_failure(db, job, e, traceback.format_exc())
+
+	print("\nDone, {} unchanged classes skipped".format(unchanged))
+
+# Put/get that give up when stop is set, so a dead pipeline doesn't leave threads
+# blocked forever. The timeouts also keep Ctrl-C working on the main thread.
+def _put(q, item, stop):
+	while not stop.is_set():
+		try:
+			q.put(item, timeout=1)
+			return True
+		except Queue.Full:
+			pass
+	return False
+
+def _get(q, stop):
+	while not stop.is_set():
+		try:
+			return q.get(timeout=1)
+		except Queue.Empty:
+			pass
+	return _DONE
+
+# Parse page text in a pool process. Returns a packed Evaluation (see Evaluation.pack),
+# since BeautifulSoup results are expensive to pickle, or a scrape error, and the
+# seconds spent parsing so the parent can record it.
+def _parse_packed(args):
+	parse, text = args
+	if text is None: # Download failed
+		return None, None, None
+	start = time.time()
+	try:
+		ev = parse(text)
+		ev.SourceHash = source_hash(text)
+		return ev.pack(), None, time.time() - start
+	except scrape_errors as e:
+		return None, (e, traceback.format_exc()), time.time() - start
+
+# Parse (job, text, error) items into (job, ev, error) items, keeping their order.
+# Items that already have an error are passed through. If pool is given, pages are
+# sent to its processes to parse, otherwise they're parsed here.
+def parse_items(items, parse, pool=None):
+	if not pool:
+		for job, text, error in items:
+			ev = None
+			if not error:
+				try:
+					with metrics.timed('parse'):
+						ev = parse(text)
+					ev.ADLN = job[3]
+					ev.SourceHash = source_hash(text)
+				except scrape_errors as e:
+					error = (e, traceback.format_exc())
+				except Exception:
+					error = sys.exc_info()
+			yield job, ev, error
+		return
+
+	# imap pulls pages from texts() on its own thread and returns results in order,
+	# so pending lines them back up with their items
+	pending = collections.deque()
+	def texts():
+		for item in items:
+			pending.append(item)
+			yield parse, (None if item[2] else item[1])
+
+	try:
+		for packed, parse_error, seconds in pool.imap(_parse_packed, texts(), chunksize=4):
+			job, text, error = pending.popleft()
+			ev = None
+			if seconds is not None:
+				metrics.observe('parse', seconds)
+			if packed:
+				ev = Evaluation.unpack(packed)
+				ev.ADLN = job[3]
+			yield job, ev, error or parse_error
+	except Exception:
+		yield None, None, sys.exc_info()
+
+# Store a batch of (job, ev) pairs, recording failures per class
+def store_batch(db, batch):
+	if not batch:
+		return
+	jobs = {id(ev): job for job, ev in batch}
+	with metrics.timed('store'):
+		failures = db.store_many([ev for job, ev in batch], batch_size=len(batch))
+
+	failed = set(id(ev) for ev, error in failures)
+	stored = [ev for job, ev in batch if id(ev) not in failed]
+	metrics.count('classes_stored', amount=len(stored))
+	metrics.count('answer_rows', amount=sum(len(q.answers) for ev in stored for q in ev.questions))
+	for ev, error in failures:
+		record_failure(db, jobs[id(ev)], error)
+
+# Download, parse and store evals concurrently.
+# workers threads download, sharing a pool of logged in sessions. One thread parses,
+# spreading the work over pool's processes if given (see parse_items), and the
+# calling thread stores in batches, since the db connection isn't thread safe.
+# Stages are joined by bounded queues so downloads can't run far ahead of the db.
+# Pages whose hash is in known are unchanged since they were stored, and skipped.
+def run_pipeline(db, dl, jobs, workers, sessions=None, batch_size=200, parse=parse_eval, pool=None,
+				 known=set()):
+	sessions = sessions or workers
+	queue_size = workers*4
+	job_q = Queue.Queue(queue_size)
+	text_q = Queue.Queue(queue_size)
+	result_q = Queue.Queue(queue_size)
+	stop = threading.Event()
+
+	session_pool = Queue.Queue()
+	session_pool.put(dl)
+	for _ in range(sessions-1):
+		session_pool.put(dl.clone())
+
+	# Queue items are (job, payload, error). error is (exception, traceback string)
+	# for scrape errors, sys.exc_info() for anything that should end the run, or
+	# _UNCHANGED if the page doesn't need parsing.
+	def feed():
+		try:
+			for job in jobs:
+				if not _put(job_q, job, stop):
+					return
+		except Exception: # Listing failed, end the run
+			_put(result_q, (None, None, sys.exc_info()), stop)
+			return
+		for _ in range(workers):
+			_put(job_q, _DONE, stop)
+
+	def download():
+		while True:
+			job = _get(job_q, stop)
+			if job is _DONE:
+				_put(text_q, _DONE, stop)
+				return
+			sess = session_pool.get()
+			try:
+				text = sess.download_eval(job[0])
+				if source_hash(text) in known:
+					item = (job, None, _UNCHANGED)
+				else:
+					item = (job, text, None)
+			except scrape_errors as e:
+				item = (job, None, (e, traceback.format_exc()))
+			except Exception:
+				item = (job, None, sys.exc_info())
+			finally:
+				session_pool.put(sess)
+			_put(text_q, item, stop)
+
+	def downloaded():
+		remaining = workers
+		while remaining:
+			item = _get(text_q, stop)
+			if item is _DONE:
+				remaining -= 1
+			else:
+				yield item
+
+	def parse_stage():
+		for item in parse_items(downloaded(), parse, pool):
+			_put(result_q, item, stop)
+		_put(result_q, _DONE, stop)
+
+	threads = [threading.Thread(target=feed, name="feed"),
+			   threading.Thread(target=parse_stage, name="parse")]
+	threads += [threading.Thread(target=download, name="download-{}".format(i))
+					for i in range(workers)]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+
+	# jobs can be a generator still reading the listing
+	total = len(jobs) if hasattr(jobs, '__len__') else '?'
+
+	try:
+		done = 0
+		unchanged = 0
+		batch = []
+		while True:
+			item = _get(result_q, stop)
+			if item is _DONE:
+				break
+			job, ev, error = item
+			if error is not _UNCHANGED and error and len(error) == 3:
+				# Unexpected exception, re-raise it here
+				raise error[0], error[1], error[2]
+
+			done += 1
+			print("\rDownloading and parsing class {}/{} (CRN {})".format(done,total,job[1]), end='')
+
+			if error is _UNCHANGED:
+				unchanged += 1
+				metrics.count('unchanged')
+			elif error:
+				record_failure(db, job, *error)
+			else:
+				batch.append((job, ev))
+
+			# Flush when the batch is full or the writer has caught up
+			if len(batch) >= batch_size or (batch and result_q.empty()):
+				store_batch(db, batch)
+				batch = []
+		store_batch(db, batch)
+		print("\n{} unchanged classes skipped".format(unchanged), end='')
+	finally:
+		stop.set()
+
+# Rebuild the database from archived pages, without touching the network.
+# processes > 1 parses in that many processes.
+def rebuild_from_archive(db, archive, parse=parse_eval, processes=1):
+	pool = multiprocessing.Pool(processes) if processes > 1 else None
+	items = ((entry[:4], archive.read(entry[4]), None) for entry in archive.entries())
+
+	try:
+		batch = []
+		for idx, (job, ev, error) in enumerate(parse_items(items, parse, pool)):
+			if error and len(error) == 3:
+				raise error[0], error[1], error[2]
+
+			print("\rParsing archived class {}/{} (CRN {})".format(idx+1,len(archive),job[1]), end='')
+			if error:
+				record_failure(db, job, *error)
+			else:
+				batch.append((job, ev))
+
+			if len(batch) >= 200:
+				store_batch(db, batch)
+				batch = []
+		store_batch(db, batch)
+	finally:
+		if pool:
+			pool.terminate()
 
 	print("\nDone")
 
-def process_failed_scrapes(db, dl):
+def process_failed_scrapes(db, dl, workers=1, parse=parse_eval, processes=1):
 	grouped_crns = db.get_col_grouped_by(FailedScrape,'CRN',['AcademicYear','ADLN'])
 	db.clear_table(FailedScrape)
 	
 	for group in grouped_crns:
-		process_evals(db, dl, group['AcademicYear'], group['ADLN'], group['CRN'])
+		process_evals(db, dl, group['AcademicYear'], group['ADLN'], group['CRN'],
+					  workers=workers, parse=parse, processes=processes)
 
 #!!
 # check all courses for uniqueness of crns
 def validate_assumptions(db, dl):
 	pass
 
-# Check that all available courses are accounted for in db or failures
-# Does not identify duplicate CRNS #!!
-# untested #!!
-def validate_and_fix(db, dl, fix=True):
+# Listed urls of both ADLN and non-ADLN classes for each year, as {year: urls}.
+# Years are downloaded concurrently, each with its own session.
+def get_urls_by_years(dl, years):
+	results = {}
+	errors = []
+
+	def fetch(year, sess):
+		try:
+			results[year] = (sess.get_urls_by_year(year, adln=True) +
+							 sess.get_urls_by_year(year, adln=False))
+		except Exception:
+			errors.append(sys.exc_info())
+
+	threads = [threading.Thread(target=fetch, args=(year, dl if idx==0 else dl.clone()))
+					for idx, year in enumerate(years)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	if errors:
+		raise errors[0][0], errors[0][1], errors[0][2]
+	return results
+
+# Check that all available courses are accounted for in db or failures, and report
+# missing, failed and duplicate CRNs. Prints a summary per year followed by a JSON report:
+# [{"year", "listed", "missing": [{"crn", "adln", "url"}], "failed": [{"crn", "adln", "count"}],
+#   "duplicates": [{"crn", "adln", "listed", "stored", "failed"}]}]
+# A CRN is a duplicate if it's listed, stored or failed more than once for a year and ADLN.
+# That's expected when a class has several profs, but it should match between the listing and db.
+def validate_and_fix(db, dl, fix=True, workers=1, parse=parse_eval, processes=1):
 	#years = dl.get_years() #!!!
 	years = range(2006,2017)
 	years = [2010,2013,2016] #!!! remove
-	missing_urls = []
 
-	for year in years:
-		missing_in_year = []
-
-		urls = dl.get_urls_by_year(year, adln=True)
-		urls += dl.get_urls_by_year(year, adln=False)
+	listed_urls = get_urls_by_years(dl, years)
+
+	# Everything we know about these years, in one query
+	year_params = ",".join(["%s"]*len(years))
+	db.cur.execute("""SELECT AcademicYear, ADLN, CRN, 'Classes' AS Source FROM Classes
+							WHERE AcademicYear IN ({years})
+						UNION ALL
+					  SELECT AcademicYear, ADLN, CRN, 'FailedScrapes' AS Source FROM FailedScrapes
+							WHERE AcademicYear IN ({years})""".format(years=year_params),
+				   years + years)
+	stored = collections.Counter()
+	failed = collections.Counter()
+	for row in db.cur.fetchall():
+		key = (int(row['AcademicYear']), bool(row['ADLN']), int(row['CRN']))
+		if row['Source'] == 'Classes':
+			stored[key] += 1
+		else:
+			failed[key] += 1
 
+	report = []
+	missing_urls = []
+	for year in years:
+		urls = listed_urls[year]
+		listed = collections.Counter()
+		urls_by_key = collections.defaultdict(list)
 		for url in urls:
-			#!! get this from func
-			crn = re.compile('IN_CRN=(\d*)').search(url).group(1) #!!
-			adln_char = re.compile('IN_ADLN_OIX=(\d*)').search(url).group(1)
-			if adln_char not in 'OX':
-				raise ParseError("ADLN in URL must be O or X")
-			adln = adln_char=='O'
-
-			db.cur.execute("""SELECT 1 FROM ( 
-								SELECT CRN FROM Classes WHERE AcademicYear = {year} AND ADLN={adln}
-									UNION ALL
-								SELECT CRN FROM FailedScrapes WHERE AcademicYear = {year} AND ADLN={adln}
-									) a 
-								WHERE CRN = {crn}""".format(year=year,adln=adln,crn=crn))
-			if not db.cur.fetchone():
-				# Entry not found
-				missing_in_year.append(url)
-		print("{} missing entries in {}-{} out of {}".format(len(missing_in_year),year-1,year,len(urls)))
-		missing_urls += missing_in_year
+			crn, _, adln = parse_class_url(url)
+			key = (year, adln, int(crn))
+			listed[key] += 1
+			urls_by_key[key].append(url)
+
+		# A CRN can be listed more than once, like for each instructor, so an entry is
+		# missing when fewer were stored or failed than were listed. We can't tell which
+		# of its pages those were, so all of them are fixed. Pages that were stored are
+		# skipped as unchanged by process_evals.
+		missing_in_year = []
+		for key in sorted(listed):
+			shortfall = listed[key] - stored[key] - failed[key]
+			if shortfall > 0:
+				missing_in_year.append({'crn': key[2], 'adln': key[1], 'missing': shortfall,
+										'urls': urls_by_key[key]})
+
+		# More stored or failed than listed
+		in_year = lambda counter: set(key for key in counter if key[0]==year)
+		duplicates = [{'crn': key[2], 'adln': key[1],
+					   'listed': listed[key], 'stored': stored[key], 'failed': failed[key]}
+						for key in sorted(in_year(listed) | in_year(stored) | in_year(failed))
+						if stored[key] + failed[key] > listed[key]]
+
+		report.append({'year': year,
+					   'listed': len(urls),
+					   'missing': missing_in_year,
+					   'failed': [{'crn': key[2], 'adln': key[1], 'count': failed[key]}
+										for key in sorted(in_year(failed))],
+					   'duplicates': duplicates})
+
+		print("{} missing entries, {} failed and {} duplicate CRNs in {}-{} out of {}".format(
+				sum(entry['missing'] for entry in missing_in_year), len(report[-1]['failed']),
+				len(duplicates), year-1, year, len(urls)))
+		missing_urls += [url for entry in missing_in_year for url in entry['urls']]
+
+	print(json.dumps(report, sort_keys=True))
 
 	if missing_urls:
-		print("{} total missing entries".format(len(missing_urls)))
+		print("{} total missing entries".format(sum(entry['missing'] for year_report in report
+																for entry in year_report['missing'])))
 		if fix:
-			process_evals(db, dl, urls=missing_urls)
+			process_evals(db, dl, urls=missing_urls, workers=workers, parse=parse, processes=processes)
 	else:
-		print("No missing entries found") #!! notify about failed scrapes
+		print("No missing entries found")
+
+	return report
 
 def main(argv):
 	try:
-		opts, args = getopt.getopt(argv, "ry:fvb")
+		opts, args = getopt.getopt(argv, "ry:fvbj:a:uop:P:l:m:")
 	except getopt.GetoptError:
-		print("parser.py [-r] [-y YEAR | -f] [-v]") #!!
+		print("parser.py [-r] [-y YEAR | -f | -v | -o] [-j WORKERS] [-P PROCESSES] [-a ARCHIVE_DIR [-u]] [-p bs4|lxml] [-l MAX_REQUESTS_PER_SEC] [-m METRICS_FILE]") #!!
 		return
 
 	reset = False
@@ -301,6 +879,14 @@ def main(argv):
 	year = None
 	validate = False
 	build_sums = False
+	workers = 1
+	archive = None
+	refresh = False
+	offline = False
+	parse = parse_eval
+	processes = 1
+	limiter = AdaptiveRateLimiter()
+	metrics_path = None
 	for opt, arg in opts:
 		if opt =='-r':
 			reset = True
@@ -312,11 +898,53 @@ def main(argv):
 			validate = True
 		elif opt == '-b':
 			build_sums = True
+		elif opt == '-j':
+			workers = int(arg)
+		elif opt == '-a':
+			archive = EvalArchive(arg)
+		elif opt == '-u':
+			refresh = True
+		elif opt == '-o':
+			offline = True
+		elif opt == '-p':
+			parse = parsers[arg]
+		elif opt == '-P':
+			processes = int(arg)
+		elif opt == '-l':
+			limiter = AdaptiveRateLimiter(max_rate=float(arg))
+		elif opt == '-m':
+			metrics_path = arg
 
 	db = Database()
+
+	# Written every few seconds so a long run can be watched, .prom for Prometheus text
+	writer = MetricsWriter(metrics, metrics_path).start() if metrics_path else None
+	def finish():
+		if writer:
+			writer.stop()
+		print("\n" + metrics.summary())
+
+	if offline:
+		if not archive:
+			print("-o requires an archive (-a ARCHIVE_DIR)")
+			return
+		print("Rebuilding database from {} archived classes".format(len(archive)))
+		db.reset()
+		rebuild_from_archive(db, archive, parse, processes)
+		db.build_class_summaries()
+		finish()
+		return
+
+	if build_sums:
+		print("Rebuilding class summaries")
+		db.build_class_summaries()
+		return
 	
 	dl = Downloader(user=raw_input("Username: "),
-					passwd=getpass.getpass())
+					passwd=getpass.getpass(),
+					archive=archive,
+					refresh=refresh,
+					limiter=limiter)
 
 	dl.login()
 
@@ -325,22 +953,23 @@ def main(argv):
 
 	if rerun_fails:
 		print("Re-running failed scrapes")
-		process_failed_scrapes(db, dl)
+		process_failed_scrapes(db, dl, workers, parse, processes)
 	elif year:
-		process_evals(db, dl, 2015, adln=True)
-		process_evals(db, dl, 2015, adln=False)		
+		process_evals(db, dl, 2015, adln=True, workers=workers, parse=parse, processes=processes)
+		process_evals(db, dl, 2015, adln=False, workers=workers, parse=parse, processes=processes)		
 	elif validate:
-		validate_and_fix(db, dl)
-	elif build_sums:
-		pass
+		validate_and_fix(db, dl, workers=workers, parse=parse, processes=processes)
 	else:
 		for year in range(2016,2017):
-			process_evals(db, dl, year, adln=True)
-			process_evals(db, dl, year, adln=False)		
+			process_evals(db, dl, year, adln=True, workers=workers, parse=parse, processes=processes)
+			process_evals(db, dl, year, adln=False, workers=workers, parse=parse, processes=processes)		
 		#!! process all years
 
+	print("Lookup cache: {hits} hits, {misses} misses".format(**db.ids.stats()))
+	finish()
 
-	db.build_class_summaries()
+	# Only summarize what this run added, -b rebuilds everything
+	db.build_class_summaries(incremental=True)
     # with open("sampleeval.html") as f:
     #     ev = parse_eval(f.read())
     #     db.store(ev)
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+
+import time
+import random
+import threading
+
+# Token bucket rate limiter that adapts its rate to how the server is coping.
+# Every request takes a token. Tokens refill at rate per second, up to burst.
+# The rate backs off multiplicatively when requests fail or come back slower than
+# target_latency, and creeps back up additively while they're fast, so we run as
+# quickly as bannerweb allows without getting throttled.
+# Shared by every Downloader in a run, so the limit is for the whole run.
+class AdaptiveRateLimiter(object):
+    def __init__(self, rate=4.0, min_rate=0.2, max_rate=20.0, burst=4,
+                 target_latency=2.0, increase=0.2, backoff=0.5):
+        self.rate = min(rate, max_rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.target_latency = target_latency
+        self.increase = increase
+        self.backoff = backoff
+
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    # Block until a request is allowed
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill)*self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens)/self.rate
+            time.sleep(wait)
+
+    # Adjust the rate after a request. latency is in seconds.
+    def record(self, latency, error=False):
+        with self.lock:
+            if error or latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate*self.backoff)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+# Seconds to wait before retry number attempt (from 0): exponential backoff with
+# full jitter, so retrying downloaders don't all come back at once
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    return random.uniform(0, min(cap, base * 2**attempt))